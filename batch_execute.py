@@ -1,136 +1,376 @@
-import time
-import logging
-import os
-import boto3
-
-import config
-import connections
-
-logLevel = (os.getenv("logLevel", "INFO")).upper()
-STAGE = (os.getenv("stage", "TEST")).upper()
-SLEEP_TIMER = int(os.getenv("sleep_timer_CA_TO_US", 60))
-CA_TO_US_BATCH_PATH = os.getenv("CA_TO_US_BATCH_PATH")
-
-logging.basicConfig(
-    level=logging.INFO if logLevel == "INFO" else logging.ERROR,
-    datefmt="%H:%M:%S",
-    format="%(levelname)s: %(module)s:%(funcName)s:%(lineno)d: %(asctime)s: %(message)s",
-)
-LOG = logging.getLogger(__name__)
-
-
-def execute_batch(vin=None):
-    """
-    Execute the batch on the server
-    :param vin : string, vin to be processed
-    :return : a boolean , whether the batch execution is successful or not 
-    """
-
-    assert vin is not None, "Please provide proper VIN"
-
-    try:
-        LOG.info("Making changes in local file and preparing for upload..")
-        local_changes = change_local_files_batch_execution(vin)
-        assert local_changes is not False, "File changes failed for Upload"
-
-        server_connection_flag, client = connections.server_connection(STAGE)
-        assert server_connection_flag is not 0, "Server connection not established"
-
-        execute_batch = upload_and_execute_batch(client)
-        assert (execute_batch is not False), "Error occurred in executing batch for Factory Feed"
-        time.sleep(SLEEP_TIMER)
-        return execute_batch, False
-
-    except Exception as e:
-        LOG.error(f"Error Occurred : {str(e)}")
-        return False, e
-
-
-def change_local_files_batch_execution(vin):
-
-    """
-    create a local file with vin to upload on the server
-    :param vin : string ,vin to write on the local file
-    :return update_flag : boolean , whether the file is successfully created or not
-    """
-
-    txt_file_write = False
-    update_flag = False
-    try:
-        file_to_write_vin = config.filetowrite_vin
-        data_to_write = vin
-        txt_file_write = write_files(data_to_write, file_to_write_vin)
-        if txt_file_write:
-            LOG.info("Vin changed in Local .txt file")
-            update_flag = True
-    except Exception as e:
-        LOG.error(f"Error Occurred : {str(e)}")
-        update_flag = False
-    return update_flag
-
-
-def upload_and_execute_batch(client):
-    """
-    Upload the file created on the server and run the  batch from the specified location
-    :param client: object, connection to server
-    :return execution_script_flag : boolean , whether the batch is sucessfully executed or not
-    """
-
-    execution_script_flag = False
-
-    sftp = client.open_sftp()
-
-    LOG.info("Uploading Destination-CA-US-panaupdate-query.txt on server")
-
-    try:
-        file_upload_path = config.file_path
-        sftp.put(config.filetowrite_vin, config.file_path)
-        upload_to_server_flag = True
-        LOG.info("Files uploaded to server ")
-    except Exception as e:
-        LOG.error(e)
-        LOG.error("Problem while uploading file to the server")
-        upload_to_server_flag = False
-        execution_script_flag = False
-
-    if upload_to_server_flag:
-        LOG.info("Executing the Script...")
-        try:
-            stdin, stdout, stderr = client.exec_command("(" + CA_TO_US_BATCH_PATH + ")")
-
-            error = stderr.readlines()
-            if len(error) > 0:
-                LOG.error(f"Errors while execution : {str(error)}")
-            LOG.info(f"Output of execution : {str(stdout.readlines())}")
-            if error:
-                execution_script_flag = False
-            else:
-                execution_script_flag = True
-        except Exception as e:
-            LOG.error(e)
-            LOG.error("Problem executing the Script")
-            execution_script_flag = False
-    sftp.close()
-    LOG.info("Closing client connection...")
-    client.close()
-    LOG.info("Client connection closed")
-    return execution_script_flag
-
-
-def write_files(data, file):
-    """
-    Creates local file in lambda at run time
-
-    :param data: payload of the file
-    :param file: file path
-    :return: boolean True for success False otherwise
-    """
-    try:
-        with open(file, "w") as file_to_write:
-            file_to_write.writelines(data)
-        LOG.info("Local file created")
-        return True
-    except Exception as e:
-        LOG.error(e)
-        LOG.error("Problem occurred while creating local file ")
-        return False
+import time
+import logging
+import os
+import random
+import select
+import shlex
+import uuid
+from collections import deque
+from io import BytesIO
+
+import config
+import connections
+import dao
+import log_setup
+import tracing
+
+STAGE = (os.getenv("stage", "TEST")).upper()
+SLEEP_TIMER = int(os.getenv("sleep_timer_CA_TO_US", 60))
+CA_TO_US_BATCH_PATH = os.getenv("CA_TO_US_BATCH_PATH")
+WAIT_MODE = os.getenv("wait_mode_CA_TO_US", "poll").lower()
+POLL_INITIAL_DELAY = float(os.getenv("poll_initial_delay_CA_TO_US", 1))
+POLL_MAX_DELAY = float(os.getenv("poll_max_delay_CA_TO_US", 10))
+POLL_TIMEOUT = float(os.getenv("poll_timeout_CA_TO_US", 300))
+EXECUTION_TIMEOUT = float(os.getenv("execution_timeout_CA_TO_US", 900))
+OUTPUT_BUFFER_LINES = int(os.getenv("output_buffer_lines_CA_TO_US", 200))
+STDOUT = "stdout"
+STDERR = "stderr"
+DEADLINE_MARGIN = float(os.getenv("deadline_margin_CA_TO_US", 15))
+BATCH_LOCK = os.getenv("batch_lock_CA_TO_US", "none").lower()
+BATCH_LOCK_PATH = os.getenv("batch_lock_path_CA_TO_US")
+BATCH_LOCK_TIMEOUT = float(os.getenv("batch_lock_timeout_CA_TO_US", 600))
+LOCK_BUSY_STATUS = 75
+COMMAND_NOT_FOUND_STATUS = 127
+FLOCK = "flock"
+SLEEP = "sleep"
+POLL = "poll"
+
+LOG = logging.getLogger(__name__)
+
+
+def execute_batch(vin=None):
+    """
+    Execute the batch on the server
+    :param vin : string or list of strings, vin(s) to be processed in a single batch run
+    :return : a boolean , whether the batch execution is successful or not 
+
+    With wait_mode_CA_TO_US=sleep the function waits SLEEP_TIMER seconds after the run,
+    otherwise the caller is expected to use wait_for_conversion.
+    """
+
+    assert vin is not None, "Please provide proper VIN"
+    assert len(vin) > 0, "Please provide proper VIN"
+
+    try:
+        LOG.info("Preparing the query file for upload..")
+        query_file = build_query_file(vin)
+
+        execute_batch = run_on_session(query_file)
+        assert (execute_batch is not False), "Error occurred in executing batch for Factory Feed"
+        if WAIT_MODE == SLEEP:
+            with tracing.span("batch_sleep"):
+                time.sleep(SLEEP_TIMER)
+        return execute_batch, False
+
+    except Exception as e:
+        LOG.error("Error Occurred : %s", e)
+        return False, e
+
+
+def run_on_session(query_file, retry_reused=True):
+    """
+    Uploads the query file and runs the batch on the kept SSH session. An error on a reused session marks it
+    broken and the run is tried once more on a new connection.
+    :param query_file: bytes, content of the file
+    :param retry_reused: boolean, whether a failed reused session is retried on a new connection
+    :return boolean, whether the batch is successfully executed
+    """
+    session = connections.get_ssh_session(STAGE)
+    try:
+        execution_flag = upload_and_execute_batch(session.client, query_file, session.get_sftp(), raise_errors=True)
+    except Exception as e:
+        connections.release_ssh_session(session, broken=True)
+        if not (retry_reused and session.reused):
+            raise
+        LOG.warning("Reused SSH session with %s server failed : %s, retrying on a new connection", STAGE, e)
+        return run_on_session(query_file, retry_reused=False)
+    connections.release_ssh_session(session)
+    return execution_flag
+
+
+def get_deadline(context=None):
+    """
+    Gives the monotonic time until which the conversion can be awaited
+    :param context: lambda context, used to stay within the remaining execution time
+    :return : float, deadline in time.monotonic() seconds
+    """
+    timeout = POLL_TIMEOUT
+    if context is not None:
+        remaining = context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN
+        timeout = max(0, min(timeout, remaining))
+    return time.monotonic() + timeout
+
+
+@tracing.traced("conversion_wait")
+def wait_for_conversion(db_connection=None, vins=None, deadline=None, started_at=None):
+    """
+    Polls VEHICLE table with exponential backoff and jitter until all the vins are US or the deadline is reached.
+    The table is read at least once, so it also serves as the check after a fixed sleep.
+    :param db_connection: ibm_db connect object
+    :param vins: iterable of vins processed by the batch
+    :param deadline: float, time.monotonic() after which polling stops, single read when None
+    :param started_at: float, time.monotonic() when the batch started, used to measure the time-to-convert
+    :return conversion_times: dict of converted vin -> seconds from started_at until seen as US
+    :return attempts: int, number of reads of VEHICLE table
+    """
+
+    assert db_connection is not None, "Connection not established"
+    assert vins is not None, "Please provide proper VINs"
+
+    if started_at is None:
+        started_at = time.monotonic()
+    pending = set(vins)
+    conversion_times = {}
+    attempts = 0
+    delay = POLL_INITIAL_DELAY
+    while True:
+        attempts += 1
+        for vin, country in dao.iter_destination_countries(db_connection, list(pending)):
+            if country == dao.US and vin in pending:
+                pending.discard(vin)
+                conversion_times[vin] = time.monotonic() - started_at
+                LOG.info("VIN %s converted after %.1f seconds", vin, conversion_times[vin],
+                         extra=log_setup.per_vin(vin))
+        if not pending or deadline is None:
+            break
+        sleep_for = random.uniform(delay / 2, delay)
+        if time.monotonic() + sleep_for > deadline:
+            LOG.info("Deadline reached with %s VINs still not converted", len(pending))
+            break
+        time.sleep(sleep_for)
+        delay = min(delay * 2, POLL_MAX_DELAY)
+    LOG.info("%s VINs converted, VEHICLE table read %s times", len(conversion_times), attempts)
+    return conversion_times, attempts
+
+
+def build_query_file(vin):
+    """
+    Builds in memory the query file to upload on the server
+    :param vin : string or list of strings, vin(s) to write in the file
+    :return : bytes, content of the file
+    """
+    return format_vins(vin).encode()
+
+
+def format_vins(vin):
+    """
+    Builds the content of the query file, one vin per line
+    :param vin : string or list of strings, vin(s) to be processed
+    :return : string, content of the query file
+    """
+    if isinstance(vin, str):
+        return vin
+    return "\n".join(vin)
+
+
+def upload_and_execute_batch(client, query_file, sftp=None, raise_errors=False):
+    """
+    Upload the query file on the server and run the  batch from the specified location
+    :param client: object, connection to server
+    :param query_file: bytes, content of the query file
+    :param sftp: SFTP channel of a kept session, when None a channel is opened and the client is closed at the end
+    :param raise_errors: boolean, raise the upload and execution errors instead of returning False, so that
+        the caller can drop a broken session
+    :return execution_script_flag : boolean , whether the batch is sucessfully executed or not
+    """
+
+    execution_script_flag = False
+
+    own_connection = sftp is None
+    if own_connection:
+        sftp = client.open_sftp()
+
+    LOG.info("Uploading Destination-CA-US-panaupdate-query.txt on server")
+
+    try:
+        temp_path = stage_query_file(sftp, query_file, config.file_path)
+        upload_to_server_flag = True
+        LOG.info("Files uploaded to server ")
+    except Exception as e:
+        LOG.error(e)
+        LOG.error("Problem while uploading file to the server")
+        if raise_errors:
+            raise
+        upload_to_server_flag = False
+        execution_script_flag = False
+
+    if upload_to_server_flag:
+        LOG.info("Executing the Script...")
+        try:
+            exit_status, output, error = run_staged_batch(client, sftp, temp_path, config.file_path)
+
+            if len(error) > 0:
+                LOG.error("Errors while execution : %s", list(error))
+            LOG.info("Output of execution : %s lines, last one %r", len(output), output[-1] if output else "")
+            if exit_status == 0:
+                execution_script_flag = True
+            else:
+                LOG.error("Script ended with exit status %s", exit_status)
+                execution_script_flag = False
+        except Exception as e:
+            LOG.error(e)
+            LOG.error("Problem executing the Script")
+            if raise_errors:
+                raise
+            execution_script_flag = False
+    if own_connection:
+        sftp.close()
+        LOG.info("Closing client connection...")
+        client.close()
+        LOG.info("Client connection closed")
+    return execution_script_flag
+
+
+@tracing.traced("remote_batch")
+def run_remote_command(client, command, timeout=EXECUTION_TIMEOUT, line_callback=None,
+                       buffer_lines=OUTPUT_BUFFER_LINES):
+    """
+    Runs a command on the server, draining stdout and stderr as they arrive so that neither can fill
+    its window and block the other
+
+    :param client: object, connection to server
+    :param command: string, command to execute
+    :param timeout: float, seconds after which the command is abandoned
+    :param line_callback: function called with (stream, line) for every output line
+    :param buffer_lines: int, number of last lines kept for each stream
+    :return exit_status: int, exit status of the command, None on timeout
+    :return output: deque, last lines of stdout
+    :return error: deque, last lines of stderr
+    """
+    channel = client.get_transport().open_session()
+    lines = {STDOUT: deque(maxlen=buffer_lines), STDERR: deque(maxlen=buffer_lines)}
+    partial = {STDOUT: b"", STDERR: b""}
+    readers = {STDOUT: (channel.recv_ready, channel.recv), STDERR: (channel.recv_stderr_ready, channel.recv_stderr)}
+    deadline = time.monotonic() + timeout
+
+    def consume(stream, data, flush=False):
+        chunks = (partial[stream] + data).split(b"\n")
+        partial[stream] = b"" if flush else chunks.pop()
+        for chunk in chunks:
+            if flush and not chunk:
+                continue
+            line = chunk.decode(errors="replace").rstrip("\r")
+            lines[stream].append(line)
+            if line_callback is not None:
+                line_callback(stream, line)
+
+    try:
+        channel.exec_command(command)
+        while True:
+            for stream, (ready, recv) in readers.items():
+                while ready():
+                    consume(stream, recv(32768))
+            if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                LOG.error("Script did not finish within %s seconds", timeout)
+                return None, lines[STDOUT], lines[STDERR]
+            select.select([channel], [], [], min(remaining, 1))
+        for stream in readers:
+            consume(stream, b"", flush=True)
+        return channel.recv_exit_status(), lines[STDOUT], lines[STDERR]
+    finally:
+        channel.close()
+
+
+def batch_command(temp_path, remote_path):
+    """
+    Builds the command moving a staged query file in place and running the batch on it, both under an flock
+    taken on the batch server, which the runs of every container see, so a run can never replace the query file
+    of a run in progress. The lock is held on a file descriptor of a subshell, which needs a POSIX login shell
+    and flock on the server but not its -E option.
+    The wait for the lock is bounded by the time left in the invocation.
+    :param temp_path: string, path given by stage_query_file
+    :param remote_path: path of the file read by the batch
+    :return string, command to execute
+    """
+    lock_path = BATCH_LOCK_PATH or remote_path + ".lock"
+    return (f"(command -v flock >/dev/null || exit {COMMAND_NOT_FOUND_STATUS}; "
+            f"flock -w {lock_timeout():g} 9 || exit {LOCK_BUSY_STATUS}; "
+            f"mv -f {shlex.quote(temp_path)} {shlex.quote(remote_path)} && ({CA_TO_US_BATCH_PATH})"
+            f") 9>{shlex.quote(lock_path)}")
+
+
+def lock_timeout():
+    """
+    :return float, seconds to wait for the lock of the batch server, at most batch_lock_timeout_CA_TO_US and
+        the time left in the invocation
+    """
+    remaining = connections.remaining_time()
+    if remaining is None:
+        return BATCH_LOCK_TIMEOUT
+    return max(0, min(BATCH_LOCK_TIMEOUT, int(remaining)))
+
+
+def run_staged_batch(client, sftp, temp_path, remote_path):
+    """
+    Runs the batch on a staged query file. With batch_lock_CA_TO_US=flock the file is moved in place and the batch
+    run under the lock of the batch server, otherwise the file is renamed over SFTP and the batch run as is.
+    The staged file is removed when it was not moved in place.
+    :param client: object, connection to server
+    :param sftp: paramiko SFTP client
+    :param temp_path: string, path given by stage_query_file
+    :param remote_path: path of the file read by the batch
+    :return exit_status, output, error: as run_remote_command
+    """
+    if BATCH_LOCK != FLOCK:
+        publish_query_file(sftp, temp_path, remote_path)
+        return run_remote_command(client, "(" + CA_TO_US_BATCH_PATH + ")")
+    try:
+        exit_status, output, error = run_remote_command(client, batch_command(temp_path, remote_path))
+    except Exception:
+        discard_query_file(sftp, temp_path)
+        raise
+    if exit_status != 0:
+        if exit_status == LOCK_BUSY_STATUS:
+            LOG.error("Batch server lock %s not acquired in time", BATCH_LOCK_PATH or remote_path + ".lock")
+        elif exit_status == COMMAND_NOT_FOUND_STATUS:
+            LOG.error("flock is not available on the batch server, unset batch_lock_CA_TO_US or install it")
+        discard_query_file(sftp, temp_path)
+    return exit_status, output, error
+
+
+def publish_query_file(sftp, temp_path, remote_path):
+    """
+    Renames a staged query file over the file read by the batch, the staged file is removed when it fails
+    :param sftp: paramiko SFTP client
+    :param temp_path: string, path given by stage_query_file
+    :param remote_path: path of the file read by the batch
+    """
+    try:
+        sftp.posix_rename(temp_path, remote_path)
+    except Exception:
+        discard_query_file(sftp, temp_path)
+        raise
+
+
+@tracing.traced("sftp_upload")
+def stage_query_file(sftp, query_file, remote_path):
+    """
+    Streams the query file to a temporary name next to remote_path, leaving the file read by the batch untouched.
+    run_staged_batch moves it in place, so the batch never reads a partially written file.
+    :param sftp: paramiko SFTP client
+    :param query_file: bytes, content of the file
+    :param remote_path: path of the file on the server
+    :return string, temporary path of the uploaded file
+    """
+    temp_path = f"{remote_path}.{uuid.uuid4().hex}.part"
+    try:
+        sftp.putfo(BytesIO(query_file), temp_path, file_size=len(query_file))
+    except Exception:
+        discard_query_file(sftp, temp_path)
+        raise
+    return temp_path
+
+
+def discard_query_file(sftp, temp_path):
+    """
+    Removes a staged file, ignoring a missing one
+    :param sftp: paramiko SFTP client
+    :param temp_path: string, path given by stage_query_file
+    """
+    try:
+        sftp.remove(temp_path)
+    except IOError:
+        pass
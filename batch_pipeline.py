@@ -0,0 +1,339 @@
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+import batch_execute
+import batch_scheduler
+import config
+import connections
+import dao
+import outcomes
+
+STAGE = (os.getenv("stage", "TEST")).upper()
+PIPELINE_CHUNK_SIZE = int(os.getenv("pipeline_chunk_size_CA_TO_US", 1000))
+PIPELINE_QUEUE_SIZE = int(os.getenv("pipeline_queue_size_CA_TO_US", 1))
+PIPELINE_VERIFY_TIMEOUT = float(os.getenv("pipeline_verify_timeout_CA_TO_US", batch_execute.POLL_TIMEOUT))
+
+LOG = logging.getLogger(__name__)
+
+
+class ChunkPipeline:
+    """
+    Runs a large set of VINs through the remote batch chunk by chunk, as three stages connected by bounded queues:
+    the next chunk is uploaded under a temporary name while the current one runs, and the chunks already run are
+    verified against VEHICLE table while the later ones go through the batch.
+    The VINs are read lazily and only the per-chunk counts are kept, so memory stays flat whatever the input size.
+    """
+
+    def __init__(self, chunk_size=PIPELINE_CHUNK_SIZE, queue_size=PIPELINE_QUEUE_SIZE, on_chunk=None, server=STAGE,
+                 db=None, verify_timeout=PIPELINE_VERIFY_TIMEOUT):
+        """
+        :param chunk_size: int, VINs per query file and remote batch run
+        :param queue_size: int, chunks waiting between two stages
+        :param on_chunk: function called with the report of each verified chunk, including its converted
+            and failed VINs
+        :param server: String, name of the batch server
+        :param db: String, name of the database, CVP_<stage> by default
+        :param verify_timeout: float, seconds during which a chunk is polled for its conversion
+        """
+        assert chunk_size > 0, "Chunk size must be positive"
+        assert queue_size > 0, "Queue size must be positive"
+
+        self.chunk_size = chunk_size
+        self.on_chunk = on_chunk
+        self.server = server
+        self.db = db or "CVP_" + STAGE
+        self.verify_timeout = verify_timeout
+        self.staged = queue.Queue(maxsize=queue_size)
+        self.executed = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.errors = []
+        self.reports = []
+        self.totals = {"chunks": 0, "vins": 0, "converted": 0, "failed": 0}
+
+    def run(self, vins):
+        """
+        Converts the VINs, returning once every chunk is verified
+        :param vins: iterable of vins, read as the pipeline progresses
+        :return dict with the totals, the overall throughput and the per-chunk reports
+        """
+        started_at = time.monotonic()
+        session = connections.get_ssh_session(self.server)
+        broken = False
+        stager = threading.Thread(target=self.stage_chunks, args=(vins, session), name="pipeline-stage", daemon=True)
+        verifier = threading.Thread(target=self.verify_chunks, name="pipeline-verify", daemon=True)
+        stager.start()
+        verifier.start()
+        try:
+            self.execute_chunks(session)
+        except Exception as e:
+            LOG.error("Pipeline stopped : %s", e)
+            broken = True
+            self.stop.set()
+            raise
+        finally:
+            self.put(self.executed, None)
+            verifier.join()
+            stager.join()
+            self.discard_staged(session)
+            connections.release_ssh_session(session, broken)
+        if self.errors:
+            raise self.errors[0]
+
+        elapsed = time.monotonic() - started_at
+        summary = dict(self.totals, seconds=round(elapsed, 3),
+                       vins_per_sec=round(self.totals["vins"] / elapsed, 3) if elapsed else None,
+                       chunk_reports=self.reports)
+        LOG.info("Pipeline done : %s VINs in %s chunks, %s converted, %s failed, %.1f seconds, %s VINs/sec",
+                 self.totals["vins"], self.totals["chunks"], self.totals["converted"], self.totals["failed"], elapsed,
+                 summary["vins_per_sec"])
+        return summary
+
+    def stage_chunks(self, vins, session):
+        """
+        First stage: splits the VINs into chunks and uploads each one under a temporary name, on its own SFTP channel
+        :param vins: iterable of vins
+        :param session: connections.SSHSession
+        """
+        sftp = None
+        try:
+            sftp = session.client.open_sftp()
+            for index, chunk in enumerate(dao.chunked(vins, self.chunk_size)):
+                report = {"chunk": index, "vins": len(chunk)}
+                start = time.monotonic()
+                temp_path, error = None, None
+                try:
+                    temp_path = batch_execute.stage_query_file(sftp, batch_execute.build_query_file(chunk),
+                                                               config.file_path)
+                except Exception as e:
+                    LOG.error("Problem while uploading chunk %s : %s", index, e)
+                    error = e
+                report["upload_seconds"] = round(time.monotonic() - start, 3)
+                if not self.put(self.staged, (chunk, temp_path, error, report)):
+                    if temp_path is not None:
+                        batch_execute.discard_query_file(sftp, temp_path)
+                    return
+        except Exception as e:
+            LOG.error("Problem while reading the VINs : %s", e)
+            self.errors.append(e)
+        finally:
+            self.put(self.staged, None)
+            if sftp is not None:
+                sftp.close()
+
+    def discard_staged(self, session):
+        """
+        Removes from the server the staged files of the chunks left in the queue when the pipeline stopped
+        :param session: connections.SSHSession
+        """
+        while True:
+            try:
+                item = self.staged.get_nowait()
+            except queue.Empty:
+                return
+            if item is None or item[1] is None:
+                continue
+            try:
+                batch_execute.discard_query_file(session.get_sftp(), item[1])
+            except Exception as e:
+                LOG.warning("Staged file %s of chunk %s not removed : %s", item[1], item[3]["chunk"], e)
+
+    def execute_chunks(self, session):
+        """
+        Second stage: runs the batch on each staged chunk. Runs are serialized with the ones of batch_scheduler
+        in the container, and with the other containers by the lock of the batch server when one is configured.
+        :param session: connections.SSHSession
+        """
+        sftp = session.get_sftp()
+        while True:
+            item = self.get(self.staged)
+            if item is None:
+                return
+            chunk, temp_path, error, report = item
+            report["started_at"] = time.monotonic()
+            if error is None:
+                try:
+                    with batch_scheduler.scheduler.run_lock:
+                        exit_status, _, stderr = batch_execute.run_staged_batch(session.client, sftp, temp_path,
+                                                                                config.file_path)
+                    if exit_status != 0:
+                        error = Exception(f"Script ended with exit status {exit_status} : {list(stderr)[-5:]}")
+                except Exception as e:
+                    error = e
+                if error is not None:
+                    LOG.error("Problem executing chunk %s : %s", report['chunk'], error)
+                    if not session.is_alive():
+                        raise error
+            report["run_seconds"] = round(time.monotonic() - report["started_at"], 3)
+            if not self.put(self.executed, (chunk, error, report)):
+                return
+
+    def verify_chunks(self):
+        """
+        Third stage: polls VEHICLE table until the VINs of the executed chunks are US or their timeout is reached.
+        All the chunks being verified are read together, each one until its own deadline, so a VIN which is never
+        converted does not hold back the chunks run after it. Chunks are reported in the order they were run.
+        """
+        db_connection = None
+        verifying = deque()
+        done = False
+        delay = batch_execute.POLL_INITIAL_DELAY
+        next_poll = time.monotonic()
+        try:
+            while not done or verifying:
+                if not done:
+                    try:
+                        item = self.executed.get(
+                            timeout=min(1, max(0, next_poll - time.monotonic())) if verifying else 1)
+                    except queue.Empty:
+                        if self.stop.is_set():
+                            return
+                    else:
+                        if item is None:
+                            done = True
+                        else:
+                            chunk, error, report = item
+                            report["poll_attempts"] = 0
+                            verifying.append({"chunk": chunk, "error": error, "report": report, "converted": {},
+                                              "pending": set(chunk) if error is None else set(),
+                                              "started_at": time.monotonic()})
+                            delay = batch_execute.POLL_INITIAL_DELAY
+                            next_poll = time.monotonic()
+                        continue
+                elif next_poll > time.monotonic():
+                    time.sleep(next_poll - time.monotonic())
+                if next_poll <= time.monotonic():
+                    db_connection = self.poll_chunks(db_connection, [entry for entry in verifying if entry["pending"]])
+                    next_poll = time.monotonic() + random.uniform(delay / 2, delay)
+                    delay = min(delay * 2, batch_execute.POLL_MAX_DELAY)
+                while verifying and (not verifying[0]["pending"]
+                                     or next_poll > verifying[0]["started_at"] + self.verify_timeout):
+                    entry = verifying.popleft()
+                    entry["report"]["verify_seconds"] = round(time.monotonic() - entry["started_at"], 3)
+                    self.finish_chunk(entry["chunk"], entry["converted"], entry["error"], entry["report"])
+        except Exception as e:
+            LOG.error("Verification stopped : %s", e)
+            self.errors.append(e)
+            self.stop.set()
+        finally:
+            if db_connection is not None:
+                connections.release_database_connection(db_connection)
+
+    def poll_chunks(self, db_connection, entries):
+        """
+        Reads once the destination country of the VINs still pending in the chunks being verified
+        :param db_connection: ibm_db connect object, None before the first read
+        :param entries: list of the chunks being verified, with their pending VINs
+        :return ibm_db connect object, opened on the first read
+        """
+        owners = {}
+        for entry in entries:
+            entry["report"]["poll_attempts"] += 1
+            for vin in entry["pending"]:
+                owners.setdefault(vin, []).append(entry)
+        try:
+            if db_connection is None:
+                db_connection = connections.get_database_connection(self.db)
+            for vin, country in dao.iter_destination_countries(db_connection, list(owners)):
+                if country != dao.US:
+                    continue
+                for entry in owners.get(vin, []):
+                    if vin in entry["pending"]:
+                        entry["pending"].discard(vin)
+                        entry["converted"][vin] = time.monotonic() - entry["report"]["started_at"]
+        except Exception as e:
+            LOG.error("Problem verifying chunks %s : %s", [entry["report"]["chunk"] for entry in entries], e)
+            for entry in entries:
+                entry["error"] = e
+                entry["pending"].clear()
+        return db_connection
+
+    def finish_chunk(self, chunk, converted, error, report):
+        """
+        Reports a verified chunk, adds it to the totals and to the outcome history
+        :param chunk: list of vins
+        :param converted: dict of converted vin -> seconds until seen as US
+        :param error: exception which failed the whole chunk, None otherwise
+        :param report: dict of the chunk timings
+        """
+        elapsed = time.monotonic() - report.pop("started_at")
+        report["converted"] = len(converted)
+        report["failed"] = len(chunk) - len(converted)
+        report["vins_per_sec"] = round(len(chunk) / elapsed, 3) if elapsed else None
+        report["error"] = str(error) if error is not None else None
+        LOG.info("Chunk %s : %s/%s VINs converted, upload %ss, run %ss, verify %ss, %s VINs/sec", report["chunk"],
+                 report["converted"], report["vins"], report["upload_seconds"], report["run_seconds"],
+                 report["verify_seconds"], report["vins_per_sec"], extra={"chunk": report["chunk"]})
+        self.reports.append(report)
+        self.totals["chunks"] += 1
+        self.totals["vins"] += len(chunk)
+        self.totals["converted"] += len(converted)
+        self.totals["failed"] += len(chunk) - len(converted)
+        reason = report["error"] or "conversion incomplete even after batch execution"
+        self.record_outcomes(chunk, converted, reason, error, report)
+        if self.on_chunk is not None:
+            self.on_chunk(dict(report, converted_vins=list(converted),
+                               failed_vins={vin: reason for vin in chunk if vin not in converted}))
+
+    def record_outcomes(self, chunk, converted, reason, error, report):
+        """
+        Appends the VINs of a verified chunk to the outcome history, with the chunk timings as stages
+        :param chunk: list of vins
+        :param converted: dict of converted vin -> seconds until seen as US
+        :param reason: string, reason of the failure of the VINs not converted
+        :param error: exception which failed the whole chunk, None otherwise
+        :param report: dict of the chunk timings
+        """
+        outcome = outcomes.BatchOutcome(chunk)
+        outcome.batch_size = len(chunk)
+        outcome.poll_attempts = report.get("poll_attempts")
+        outcome.conversion_times.update(converted)
+        results = {}
+        for vin in chunk:
+            if vin in converted:
+                results[vin] = (None, outcomes.SUCCESS)
+            else:
+                results[vin] = (reason, outcomes.FAILED)
+                outcome.categories[vin] = outcomes.BATCH_FAILED if error is not None else outcomes.INCOMPLETE
+        outcomes.record(outcome, results, {"sftp_upload": report["upload_seconds"] * 1000,
+                                           outcomes.REMOTE_BATCH: report["run_seconds"] * 1000,
+                                           "conversion_wait": report["verify_seconds"] * 1000})
+
+    def put(self, pipe, item):
+        """
+        Queues an item unless the pipeline is stopped
+        :return boolean, whether the item was queued
+        """
+        while not self.stop.is_set():
+            try:
+                pipe.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, pipe):
+        """
+        Takes the next item, None once the previous stage is done or the pipeline is stopped
+        """
+        while True:
+            try:
+                return pipe.get(timeout=1)
+            except queue.Empty:
+                if self.stop.is_set():
+                    return None
+
+
+def run_pipeline(vins, chunk_size=PIPELINE_CHUNK_SIZE, on_chunk=None):
+    """
+    Converts a large set of VINs with a ChunkPipeline
+    :param vins: iterable of vins
+    :param chunk_size: int, VINs per remote batch run
+    :param on_chunk: function called with the report of each verified chunk
+    :return dict with the totals, the overall throughput and the per-chunk reports
+    """
+    return ChunkPipeline(chunk_size=chunk_size, on_chunk=on_chunk).run(vins)
@@ -0,0 +1,138 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import batch_execute
+
+COALESCE_WINDOW = float(os.getenv("coalesce_window_CA_TO_US", 0))
+MAX_BATCH_SIZE = int(os.getenv("max_batch_size_CA_TO_US", 1000))
+
+LOG = logging.getLogger(__name__)
+
+
+class BatchScheduler:
+    """
+    Merges the VINs submitted by concurrent callers of the container into one upload and one remote batch run.
+    The remote batch reads a single file, so runs are serialized: VINs submitted while a run is in
+    progress, or within the coalescing window, go together into the next run. Requests larger than
+    max_batch_size are split over several runs.
+    This only saves runs within a container, the runs of different containers are serialized by the lock
+    taken on the batch server when batch_lock_CA_TO_US=flock (see batch_execute.batch_command).
+    """
+
+    def __init__(self, window=COALESCE_WINDOW, max_batch_size=MAX_BATCH_SIZE, execute=None):
+        """
+        :param window: float, seconds to wait for more VINs after the first one is submitted
+        :param max_batch_size: int, maximum number of VINs of one run
+        :param execute: function running the batch for a list of vins, batch_execute.execute_batch by default
+        """
+        assert max_batch_size > 0, "Batch size must be positive"
+
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.execute = execute
+        self.pending = []
+        self.condition = threading.Condition()
+        self.run_lock = threading.Lock()
+        self.worker = None
+
+    def submit(self, vins):
+        """
+        Queues vins for the next batch runs, in parts of at most max_batch_size vins
+        :param vins: list of vins
+        :return list of Futures, one per part, resolving to a dict of vin -> (batch_execution, execution_error)
+        """
+        assert vins, "Please provide proper VINs"
+
+        vins = list(dict.fromkeys(vins))
+        futures = []
+        with self.condition:
+            for start in range(0, len(vins), self.max_batch_size):
+                future = Future()
+                self.pending.append((vins[start:start + self.max_batch_size], future))
+                futures.append(future)
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run_forever, name="batch-scheduler", daemon=True)
+                self.worker.start()
+            self.condition.notify_all()
+        return futures
+
+    def execute_batch(self, vins):
+        """
+        Runs vins through the batch, together with the vins of the other callers
+        :param vins: list of vins
+        :return dict of vin -> (batch_execution, execution_error)
+        """
+        results = {}
+        for future in self.submit(vins):
+            results.update(future.result())
+        return results
+
+    def run_forever(self):
+        """Worker loop taking the queued requests and running them batch after batch"""
+        while True:
+            requests = self.next_requests()
+            with self.run_lock:
+                self.run(requests)
+
+    def next_requests(self):
+        """
+        Waits for queued requests, then for the coalescing window or a full batch
+        :return list of (vins, future)
+        """
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            deadline = time.monotonic() + self.window
+            while self.pending_vins() < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            requests = []
+            batch_vins = set()
+            while self.pending:
+                vins, future = self.pending[0]
+                if requests and len(batch_vins | set(vins)) > self.max_batch_size:
+                    break
+                self.pending.pop(0)
+                requests.append((vins, future))
+                batch_vins.update(vins)
+            return requests
+
+    def pending_vins(self):
+        """
+        :return int, number of distinct queued vins
+        """
+        return len({vin for vins, _ in self.pending for vin in vins})
+
+    def run(self, requests):
+        """
+        Runs the merged vins of the requests and resolves their futures
+        :param requests: list of (vins, future)
+        """
+        vins = list(dict.fromkeys(vin for request_vins, _ in requests for vin in request_vins))
+        LOG.info("Running batch for %s VINs of %s requests", len(vins), len(requests))
+        try:
+            execute = self.execute or batch_execute.execute_batch
+            batch_execution, execution_error = execute(vins)
+        except Exception as e:
+            LOG.error("Error Occurred : %s", e)
+            batch_execution, execution_error = False, e
+        for request_vins, future in requests:
+            future.set_result({vin: (batch_execution, execution_error) for vin in request_vins})
+
+
+scheduler = BatchScheduler()
+
+
+def execute_batch(vins):
+    """
+    Runs vins through the shared scheduler of the container
+    :param vins: list of vins
+    :return dict of vin -> (batch_execution, execution_error)
+    """
+    return scheduler.execute_batch(vins)
@@ -0,0 +1,93 @@
+"""Cold-start profile of the lambda modules.
+
+Imports the handler module in a fresh interpreter with -X importtime and reports the total import time,
+the slowest imports, which heavy libraries were loaded at import and what importing each of them later
+costs. Pass --eager to profile the eager_init=true startup instead.
+
+Run from the repository root:
+    python -m benchmarks.coldstart --top 15
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HEAVY_MODULES = ("boto3", "paramiko", "ibm_db")
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+import_seconds = time.perf_counter() - start
+heavy = {heavy!r}
+loaded = [name for name in heavy if name in sys.modules]
+deferred = {{}}
+for name in heavy:
+    if name in loaded:
+        continue
+    start = time.perf_counter()
+    try:
+        __import__(name)
+        deferred[name] = time.perf_counter() - start
+    except ImportError:
+        deferred[name] = None
+print(json.dumps({{"import_seconds": import_seconds, "loaded": loaded, "deferred": deferred}}))
+"""
+
+
+def parse_importtime(stderr):
+    """
+    :param stderr: string, output of python -X importtime
+    :return list of (cumulative microseconds, self microseconds, module)
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        imports.append((int(cumulative_us), int(self_us), name.rstrip()))
+    return imports
+
+
+def profile(module="lambda_handler", eager=False):
+    """
+    :param module: string, module imported by the lambda runtime
+    :param eager: boolean, profile with eager_init=true
+    :return dict with the probe result and the import timings
+    """
+    env = dict(os.environ)
+    env["eager_init"] = "true" if eager else "false"
+    env.setdefault("logLevel", "ERROR")
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+        capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["imports"] = parse_importtime(completed.stderr)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cold-start import profile of the lambda modules")
+    parser.add_argument("--module", default="lambda_handler", help="module imported by the lambda runtime")
+    parser.add_argument("--top", type=int, default=15, help="number of slowest imports to list")
+    parser.add_argument("--eager", action="store_true", help="profile with eager_init=true")
+    args = parser.parse_args(argv)
+
+    result = profile(args.module, args.eager)
+    print(f"import {args.module}: {result['import_seconds'] * 1000:.1f} ms")
+    print(f"heavy libraries loaded at import: {', '.join(result['loaded']) or 'none'}")
+    for name, seconds in result["deferred"].items():
+        cost = "not installed" if seconds is None else f"{seconds * 1000:.1f} ms"
+        print(f"deferred import of {name}: {cost}")
+    print(f"\n{'cumulative ms':>14}{'self ms':>10}  module")
+    for cumulative_us, self_us, name in sorted(result["imports"], reverse=True)[:args.top]:
+        print(f"{cumulative_us / 1000:>14.1f}{self_us / 1000:>10.1f}  {name}")
+    return result
+
+
+if __name__ == "__main__":
+    main()
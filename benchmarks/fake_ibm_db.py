@@ -0,0 +1,134 @@
+"""In-memory stand-in for the ibm_db driver, backed by SQLite.
+
+Only the calls used by connections and dao are implemented. CVP.VEHICLE and SYSIBM.SYSDUMMY1
+live in attached in-memory databases so that the production SQL runs unchanged, except for the
+DB2-only "with ur" clause which is dropped.
+"""
+import re
+import sqlite3
+import threading
+import time
+
+QUERY_LATENCY = 0.0
+CONNECT_LATENCY = 0.0
+
+_WITH_UR = re.compile(r"\s+with\s+ur\s*$", re.IGNORECASE)
+_lock = threading.RLock()
+_database = None
+stats = {"connects": 0, "exec_immediate": 0, "prepare": 0, "execute": 0}
+
+
+def get_database():
+    """
+    :return sqlite3 connection shared by all the fake connections
+    """
+    global _database
+    with _lock:
+        if _database is None:
+            _database = sqlite3.connect(":memory:", check_same_thread=False)
+            _database.execute("ATTACH ':memory:' AS CVP")
+            _database.execute("ATTACH ':memory:' AS SYSIBM")
+            _database.execute("CREATE TABLE CVP.VEHICLE (I_VIN TEXT PRIMARY KEY, C_VHCL_TYP TEXT, N_DEST_CNTRY TEXT)")
+            _database.execute("CREATE TABLE SYSIBM.SYSDUMMY1 (IBMREQD TEXT)")
+            _database.execute("INSERT INTO SYSIBM.SYSDUMMY1 VALUES ('Y')")
+        return _database
+
+
+def load_vehicles(rows):
+    """
+    Replaces the content of VEHICLE table
+    :param rows: iterable of (vin, vehicle type, destination country)
+    """
+    database = get_database()
+    with _lock:
+        database.execute("DELETE FROM CVP.VEHICLE")
+        database.executemany("INSERT INTO CVP.VEHICLE VALUES (?, ?, ?)", rows)
+        database.commit()
+
+
+def set_destination_country(vins, country):
+    """
+    Updates N_DEST_CNTRY the way the remote batch does
+    :param vins: iterable of vins
+    :param country: string
+    :return int, number of updated rows
+    """
+    database = get_database()
+    with _lock:
+        cursor = database.executemany("UPDATE CVP.VEHICLE SET N_DEST_CNTRY = ? WHERE I_VIN = ?",
+                                      ((country, vin) for vin in vins))
+        database.commit()
+        return cursor.rowcount
+
+
+class IBM_DBConnection:
+    def __init__(self):
+        self.open = True
+
+
+class IBM_DBStatement:
+    def __init__(self, connection, sql_query):
+        self.connection = connection
+        self.sql_query = _WITH_UR.sub("", sql_query)
+        self.rows = None
+
+
+def connect(dsn, user, password):
+    time.sleep(CONNECT_LATENCY)
+    get_database()
+    stats["connects"] += 1
+    return IBM_DBConnection()
+
+
+def active(connection):
+    return connection.open
+
+
+def close(connection):
+    connection.open = False
+    return True
+
+
+def _run(statement, params=()):
+    if not statement.connection.open:
+        raise Exception("[IBM][CLI Driver] CLI0106E  Connection is closed.")
+    time.sleep(QUERY_LATENCY)
+    with _lock:
+        statement.rows = iter(get_database().execute(statement.sql_query, tuple(params)).fetchall())
+
+
+def exec_immediate(connection, sql_query):
+    stats["exec_immediate"] += 1
+    statement = IBM_DBStatement(connection, sql_query)
+    _run(statement)
+    return statement
+
+
+def prepare(connection, sql_query):
+    stats["prepare"] += 1
+    return IBM_DBStatement(connection, sql_query)
+
+
+def execute(statement, params=()):
+    stats["execute"] += 1
+    _run(statement, params)
+    return True
+
+
+def fetch_tuple(statement):
+    row = next(statement.rows, None) if statement.rows is not None else None
+    return row if row is not None else False
+
+
+def free_result(statement):
+    statement.rows = None
+    return True
+
+
+def free_stmt(statement):
+    statement.rows = None
+    return True
+
+
+def stmt_errormsg(statement=None):
+    return ""
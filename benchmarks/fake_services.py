@@ -0,0 +1,206 @@
+"""Local stand-ins for the batch server, KMS and Lambda.
+
+The batch server is a real paramiko SSH server on 127.0.0.1 serving SFTP from a temporary directory.
+Its exec handler plays the remote batch: under a server-wide lock standing for flock, it moves the staged
+query file in place, reads it and flips N_DEST_CNTRY of the listed VINs to US in the fake VEHICLE table.
+"""
+import base64
+import os
+import re
+import shlex
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import paramiko
+
+from benchmarks import fake_ibm_db
+
+USERNAME = "batch"
+PASSWORD = "batch"
+
+
+class FakeKMSClient:
+    """KMS client whose ciphertext is the base64-decoded plaintext"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+
+    def decrypt(self, CiphertextBlob):
+        time.sleep(self.latency)
+        self.calls += 1
+        return {"Plaintext": CiphertextBlob}
+
+
+class FakeLambdaClient:
+    """Lambda client keeping the invocations instead of sending them"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.invocations = []
+        self.lock = threading.Lock()
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        time.sleep(self.latency)
+        with self.lock:
+            self.invocations.append((FunctionName, Payload))
+        return {"StatusCode": 202}
+
+
+def encrypt(value):
+    """
+    :param value: string
+    :return string accepted by FakeKMSClient, to be put in the environment variables
+    """
+    return base64.b64encode(value.encode()).decode()
+
+
+class LocalSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class LocalSFTPServer(paramiko.SFTPServerInterface):
+    """SFTP server mapping the remote absolute paths under a local root directory"""
+
+    def __init__(self, server, root, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = root
+
+    def local(self, path):
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def open(self, path, flags, attr):
+        local_path = self.local(path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        try:
+            fd = os.open(local_path, flags | getattr(os, "O_BINARY", 0), 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        mode = "r+b" if flags & os.O_RDWR else ("wb" if flags & os.O_WRONLY else "rb")
+        if flags & os.O_APPEND:
+            mode = "ab"
+        handle = LocalSFTPHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        handle.filename = local_path
+        return handle
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.local(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def remove(self, path):
+        try:
+            os.remove(self.local(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        try:
+            os.replace(self.local(oldpath), self.local(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    rename = posix_rename
+
+
+class FakeSSHServer(paramiko.ServerInterface):
+    def __init__(self, batch_server):
+        self.batch_server = batch_server
+
+    def check_auth_password(self, username, password):
+        if (username, password) == (USERNAME, PASSWORD):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED_OR_NOT_SUPPORTED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.batch_server.run_batch, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+
+class FakeBatchServer:
+    """SSH/SFTP server on localhost whose exec requests run the fake CA to US batch"""
+
+    def __init__(self, query_file_path, batch_latency=0.0, handshake_latency=0.0):
+        """
+        :param query_file_path: remote path of the query file, config.file_path
+        :param batch_latency: float, seconds taken by each batch run
+        :param handshake_latency: float, seconds added to each SSH connection
+        """
+        self.query_file_path = query_file_path
+        self.batch_latency = batch_latency
+        self.handshake_latency = handshake_latency
+        self.root = tempfile.mkdtemp(prefix="ca_to_us_sftp_")
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(100)
+        self.port = self.socket.getsockname()[1]
+        self.transports = []
+        self.stats = {"connections": 0, "batch_runs": 0, "converted": 0}
+        self.lock = threading.Lock()
+        self.running = True
+        threading.Thread(target=self.accept_forever, daemon=True).start()
+
+    def accept_forever(self):
+        while self.running:
+            try:
+                sock, _ = self.socket.accept()
+            except OSError:
+                return
+            time.sleep(self.handshake_latency)
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, LocalSFTPServer, self.root)
+            transport.start_server(server=FakeSSHServer(self))
+            self.transports.append(transport)
+            self.stats["connections"] += 1
+
+    def local(self, path):
+        return os.path.join(self.root, path.lstrip("/"))
+
+    def run_batch(self, channel, command):
+        try:
+            with self.lock:
+                move = re.search(r"mv -f (.+?) &&", command)
+                if move:
+                    temp_path, remote_path = shlex.split(move.group(1))
+                    os.replace(self.local(temp_path), self.local(remote_path))
+                time.sleep(self.batch_latency)
+                with open(self.local(self.query_file_path)) as query_file:
+                    vins = [line.strip() for line in query_file if line.strip()]
+                converted = fake_ibm_db.set_destination_country(vins, "US")
+            self.stats["batch_runs"] += 1
+            self.stats["converted"] += converted
+            channel.sendall(f"{converted} VINs converted\n".encode())
+            channel.send_exit_status(0)
+        except Exception as e:
+            channel.sendall_stderr(f"{e}\n".encode())
+            channel.send_exit_status(1)
+        finally:
+            channel.close()
+
+    def close(self):
+        self.running = False
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -0,0 +1,194 @@
+"""End-to-end throughput benchmark of lambda_handler.main against local stand-ins.
+
+DB2 is replaced by benchmarks.fake_ibm_db, the batch server by a local paramiko SSH/SFTP server and
+KMS/Lambda by in-process clients, each with a configurable latency. For every VIN count the run
+reports invocations/sec, converted VINs/sec, per-stage latency from tracing, the cache counters and the peak
+traced memory.
+
+Run from the repository root:
+    python -m benchmarks.run_benchmark --vins 1 100 10000
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+from benchmarks import fake_ibm_db
+from benchmarks import fake_services
+
+BATCH = "batch"
+SINGLE = "single"
+PIPELINE = "pipeline"
+
+
+class FakeContext:
+    """Lambda context with a fixed time budget per invocation"""
+
+    def __init__(self, timeout_ms=900000):
+        self.aws_request_id = str(uuid.uuid4())
+        self.deadline = time.monotonic() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="CA to US conversion benchmark with local stand-ins")
+    parser.add_argument("--vins", type=int, nargs="+", default=[1, 100, 10000], help="VIN counts to run")
+    parser.add_argument("--mode", choices=[BATCH, SINGLE, PIPELINE], default=BATCH,
+                        help="one multi-VIN event per --event-size VINs, one invocation per VIN, "
+                             "or batch_pipeline with --chunk-size VINs per chunk")
+    parser.add_argument("--event-size", type=int, default=None, help="VINs per multi-VIN event, all by default")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="VINs per chunk in pipeline mode")
+    parser.add_argument("--kms-latency", type=float, default=0.02, help="seconds per KMS Decrypt")
+    parser.add_argument("--lambda-latency", type=float, default=0.01, help="seconds per Lambda Invoke")
+    parser.add_argument("--connect-latency", type=float, default=0.05, help="seconds per DB2 connect")
+    parser.add_argument("--query-latency", type=float, default=0.002, help="seconds per DB2 query")
+    parser.add_argument("--handshake-latency", type=float, default=0.0, help="seconds added per SSH connection")
+    parser.add_argument("--batch-latency", type=float, default=0.5, help="seconds per remote batch run")
+    parser.add_argument("--dispatch-mode", choices=["single", "aggregated"], default="single",
+                        help="one Invoke per result, or one per target lambda and dispatch_max_items results")
+    parser.add_argument("--speculative", action="store_true", help="set up the SSH session while DB2 is checked")
+    parser.add_argument("--log-level", default="ERROR", help="logLevel of the lambda modules")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    return parser.parse_args(argv)
+
+
+def prepare_environment(args):
+    """Sets the environment read by the lambda modules at import time"""
+    os.environ["logLevel"] = args.log_level
+    os.environ["stage"] = "TEST"
+    os.environ.setdefault("CA_TO_US_BATCH_PATH", "ca_to_us_batch")
+    os.environ.setdefault("poll_initial_delay_CA_TO_US", "0.1")
+    os.environ["dispatch_mode"] = args.dispatch_mode
+    os.environ["speculative_setup"] = "true" if args.speculative else "false"
+    for name in ("username", "CVP_username"):
+        os.environ[name] = fake_services.encrypt(fake_services.USERNAME)
+    for name in ("password", "CVP_password"):
+        os.environ[name] = fake_services.encrypt(fake_services.PASSWORD)
+    sys.modules.setdefault("ibm_db", fake_ibm_db)
+    fake_ibm_db.CONNECT_LATENCY = args.connect_latency
+    fake_ibm_db.QUERY_LATENCY = args.query_latency
+
+
+def vehicle_rows(count):
+    """
+    :param count: int
+    :return list of (vin, vehicle type, destination country), alternating TBM and VP4R vehicles in CA
+    """
+    return [(f"BENCH{i:012d}", "CVP_TBM" if i % 2 else "CVP_SXM", "CA") for i in range(count)]
+
+
+def run_scenario(lambda_handler, tracing, count, mode, event_size, chunk_size=1000):
+    """
+    Converts count VINs and measures the run, with the idempotency store and the caches of the previous
+    scenarios dropped since the VINs and incidents are the same
+    :return dict of measures
+    """
+    import dao
+    import idempotency
+
+    rows = vehicle_rows(count)
+    fake_ibm_db.load_vehicles(rows)
+    idempotency.set_store(idempotency.MemoryIdempotencyStore())
+    dao.vehicle_type_cache.clear()
+    items = [{"vin": vin, "incident": f"INC{i:07d}"} for i, (vin, _, _) in enumerate(rows)]
+    if mode == SINGLE:
+        events = items
+    elif mode == PIPELINE:
+        events = []
+    else:
+        size = event_size or count
+        events = [items[i:i + size] for i in range(0, count, size)]
+
+    tracing.reset()
+    invocations = []
+    tracing.add_hook(invocations.append)
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for event in events:
+            lambda_handler.main(event, FakeContext())
+        if mode == PIPELINE:
+            import batch_pipeline
+
+            chunk_reports = batch_pipeline.run_pipeline((vin for vin, _, _ in rows), chunk_size)["chunk_reports"]
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    tracing.remove_hook(invocations.append)
+
+    converted = sum(1 for row in fake_ibm_db.get_database().execute(
+        "SELECT 1 FROM CVP.VEHICLE WHERE N_DEST_CNTRY = 'US'"))
+    return {
+        "vins": count,
+        "mode": mode,
+        "invocations": len(invocations),
+        "seconds": round(elapsed, 3),
+        "invocations_per_sec": round(len(invocations) / elapsed, 3),
+        "vins_per_sec": round(converted / elapsed, 3),
+        "converted": converted,
+        "peak_memory_mb": round(peak / 1024 / 1024, 3),
+        "stages": tracing.stage_summary(),
+        "vehicle_type_cache": dao.vehicle_type_cache.stats(),
+        "statement_cache": dao.statement_cache_stats(),
+        "chunks": chunk_reports if mode == PIPELINE else [],
+    }
+
+
+def print_report(result):
+    print(f"\n{result['vins']} VINs ({result['mode']}): {result['invocations']} invocations in {result['seconds']}s, "
+          f"{result['invocations_per_sec']} invocations/s, {result['vins_per_sec']} VINs/s, "
+          f"{result['converted']} converted, peak memory {result['peak_memory_mb']} MB")
+    print(f"  vehicle type cache {result['vehicle_type_cache']}, statement cache {result['statement_cache']}")
+    print(f"  {'stage':<24}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}{'max ms':>12}")
+    for stage, summary in sorted(result["stages"].items()):
+        print(f"  {stage:<24}{summary['count']:>8}{summary['p50']:>12.2f}{summary['p95']:>12.2f}{summary['max']:>12.2f}")
+    for chunk in result["chunks"]:
+        print(f"  chunk {chunk['chunk']}: {chunk['converted']}/{chunk['vins']} converted, upload {chunk['upload_seconds']}s, "
+              f"run {chunk['run_seconds']}s, verify {chunk['verify_seconds']}s, {chunk['vins_per_sec']} VINs/s")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    prepare_environment(args)
+
+    import config
+    import dispatcher
+    import kms_decrypt
+    import lambda_handler
+    import log_setup
+    import tracing
+
+    log_setup.configure()
+
+    server = fake_services.FakeBatchServer(config.file_path, args.batch_latency, args.handshake_latency)
+    config.get_config()["TEST"]["server"] = "127.0.0.1"
+    config.get_config()["TEST"]["port"] = str(server.port)
+    kms_decrypt._kms_client = fake_services.FakeKMSClient(args.kms_latency)
+    lambda_client = fake_services.FakeLambdaClient(args.lambda_latency)
+    dispatcher.client = lambda *client_args, **client_kwargs: lambda_client
+
+    results = []
+    try:
+        for count in args.vins:
+            result = run_scenario(lambda_handler, tracing, count, args.mode, args.event_size, args.chunk_size)
+            result["batch_runs"] = server.stats["batch_runs"]
+            result["ssh_connections"] = server.stats["connections"]
+            results.append(result)
+            if not args.json:
+                print_report(result)
+    finally:
+        server.close()
+    if args.json:
+        print(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == "__main__":
+    main()
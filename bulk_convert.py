@@ -0,0 +1,291 @@
+"""Offline CA to US conversion of a large VIN file, without going through the lambda.
+
+The VINs are streamed from a CSV file (a "vin" column, or the first column) or a JSONL file (objects with a
+"vin" key, or plain strings), pre-filtered with bulk VEHICLE queries and converted chunk by chunk with
+batch_pipeline. The outcome of every VIN is appended to a JSONL results file and a checkpoint is written
+after each chunk, so that a run started again with the same arguments resumes where the previous one stopped.
+Only the outcomes of the records before the checkpoint are written and counted, the ones read ahead by the
+pre-filter are held until the chunks before them are verified. The checkpoint keeps the size of the results
+file, which a resumed run cuts back to, so the records processed again after a crash are not written twice.
+
+The same environment as the lambda is needed: the KMS-encrypted username, password, CVP_username and
+CVP_password, and CA_TO_US_BATCH_PATH.
+
+    python bulk_convert.py vins.csv --stage TEST --chunk-size 1000
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from itertools import chain
+
+import batch_pipeline
+import config
+import connections
+import dao
+import log_setup
+import planner
+
+CSV = ".csv"
+CONVERTED = "converted"
+FAILED = "failed"
+
+LOG = logging.getLogger(__name__)
+
+
+def read_vins(input_path, skip=0):
+    """
+    Streams the VINs of a CSV or JSONL file
+    :param input_path: path of the file, its extension gives the format
+    :param skip: int, number of records to skip, already processed by a previous run
+    :return generator of (record position, vin)
+    """
+    with open(input_path, newline="") as input_file:
+        if input_path.lower().endswith(CSV):
+            rows = csv.reader(input_file)
+            header = next(rows, None)
+            if header is None:
+                return
+            columns = [column.strip().lower() for column in header]
+            if "vin" in columns:
+                index = columns.index("vin")
+            else:
+                index = 0
+                rows = chain([header], rows)
+            values = (row[index] if len(row) > index else "" for row in rows)
+        else:
+            values = (jsonl_vin(line) for line in input_file if line.strip())
+        for position, vin in enumerate(values):
+            if position >= skip:
+                yield position, vin.strip()
+
+
+def jsonl_vin(line):
+    """
+    :param line: string, JSONL line holding an object with a vin key or a plain string
+    :return string, vin of the line
+    """
+    record = json.loads(line)
+    if isinstance(record, dict):
+        return record.get("vin") or ""
+    return str(record)
+
+
+def count_records(input_path):
+    """
+    :param input_path: path of the file
+    :return int, number of VIN records of the file
+    """
+    return sum(1 for _ in read_vins(input_path))
+
+
+def load_checkpoint(checkpoint_path, input_path):
+    """
+    :param checkpoint_path: path of the checkpoint file
+    :param input_path: path of the input file, the checkpoint must belong to it
+    :return dict, state of the previous run, empty when there is none
+    """
+    if not os.path.exists(checkpoint_path):
+        return {}
+    with open(checkpoint_path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    assert checkpoint.get("input") == os.path.abspath(input_path), \
+        f"Checkpoint {checkpoint_path} belongs to {checkpoint.get('input')}, use --restart to start over"
+    return checkpoint
+
+
+def save_checkpoint(checkpoint_path, checkpoint):
+    """
+    Replaces the checkpoint file atomically
+    :param checkpoint_path: path of the checkpoint file
+    :param checkpoint: dict, state of the run
+    """
+    temp_path = checkpoint_path + ".part"
+    with open(temp_path, "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(temp_path, checkpoint_path)
+
+
+class BulkConversion:
+    """Converts the VINs of a file, keeping a checkpoint of the records done"""
+
+    def __init__(self, input_path, stage="TEST", checkpoint_path=None, results_path=None,
+                 chunk_size=batch_pipeline.PIPELINE_CHUNK_SIZE, prefilter_size=dao.BULK_CHUNK_SIZE, restart=False):
+        """
+        :param input_path: path of the CSV or JSONL file
+        :param stage: TEST or PROD, selects the batch server section and the CVP_<stage> database section
+        :param checkpoint_path: path of the checkpoint, <input>.checkpoint.json by default
+        :param results_path: path of the JSONL results, <input>.results.jsonl by default
+        :param chunk_size: int, VINs per remote batch run
+        :param prefilter_size: int, VINs per bulk VEHICLE query
+        :param restart: boolean, ignore the checkpoint and start from the first record
+        """
+        config_parser = config.get_config()
+        assert config_parser.has_section(stage), f"No {stage} section in {config.ini_file}"
+        assert config_parser.has_section("CVP_" + stage), f"No CVP_{stage} section in {config.ini_file}"
+
+        self.input_path = input_path
+        self.stage = stage
+        self.db = "CVP_" + stage
+        self.checkpoint_path = checkpoint_path or input_path + ".checkpoint.json"
+        self.results_path = results_path or input_path + ".results.jsonl"
+        self.chunk_size = chunk_size
+        self.prefilter_size = prefilter_size
+        self.checkpoint = {} if restart else load_checkpoint(self.checkpoint_path, input_path)
+        self.counts = self.checkpoint.get("counts", {})
+        self.in_flight = deque()
+        self.held = deque()
+        self.first_record = self.checkpoint.get("records_done", 0)
+        self.read_position = self.first_record
+        self.lock = threading.Lock()
+        self.total = None
+        self.started_at = None
+        self.results_file = None
+
+    def run(self):
+        """
+        Converts the records not done yet
+        :return dict, counts of the VINs per outcome
+        """
+        self.total = count_records(self.input_path)
+        LOG.info("%s records in %s, %s already done", self.total, self.input_path, self.first_record)
+        self.started_at = time.monotonic()
+        db_connection = connections.database_connection(self.db)
+        try:
+            with open(self.results_path, "a") as self.results_file:
+                self.truncate_results()
+                pipeline = batch_pipeline.ChunkPipeline(chunk_size=self.chunk_size, on_chunk=self.on_chunk,
+                                                        server=self.stage, db=self.db)
+                pipeline.run(self.eligible_vins(db_connection, read_vins(self.input_path, self.first_record)))
+                self.record_held(self.total)
+                self.save(self.total)
+        finally:
+            connections.close_connection(db_connection)
+        self.print_progress(self.total)
+        return self.counts
+
+    def eligible_vins(self, db_connection, records):
+        """
+        Pre-filters the records with bulk VEHICLE queries, holding the outcome of the VINs which are not converted
+        :param db_connection: ibm_db connect object, used only by this generator
+        :param records: iterable of (record position, vin)
+        :return generator of the vins to be converted
+        """
+        for batch in dao.chunked(records, self.prefilter_size):
+            vins = [vin for _, vin in batch if vin]
+            details = {vin: (vehicle_type, country)
+                       for vin, vehicle_type, country in dao.iter_vehicle_details(db_connection, vins)}
+            for position, vin in batch:
+                partition, _, reason = planner.classify(vin, details.get(vin))
+                if partition != planner.TO_CONVERT:
+                    with self.lock:
+                        self.held.append((position, vin, partition, reason))
+                else:
+                    with self.lock:
+                        self.in_flight.append(position)
+                    yield vin
+                with self.lock:
+                    self.read_position = position + 1
+
+    def on_chunk(self, report):
+        """
+        Records the outcome of a verified chunk, moves the checkpoint and prints the progress
+        :param report: dict given by batch_pipeline.ChunkPipeline
+        """
+        for vin in report["converted_vins"]:
+            self.record(vin, CONVERTED)
+        for vin, reason in report["failed_vins"].items():
+            self.record(vin, FAILED, reason)
+        with self.lock:
+            for _ in range(report["vins"]):
+                self.in_flight.popleft()
+            records_done = self.in_flight[0] if self.in_flight else self.read_position
+        self.record_held(records_done)
+        self.save(records_done)
+        self.print_progress(records_done)
+
+    def record_held(self, records_done):
+        """
+        Records the held outcomes of the pre-filter which are before the checkpoint
+        :param records_done: int, number of leading records done
+        """
+        while True:
+            with self.lock:
+                if not self.held or self.held[0][0] >= records_done:
+                    return
+                _, vin, status, reason = self.held.popleft()
+            self.record(vin, status, reason)
+
+    def truncate_results(self):
+        """
+        Cuts the results file back to its size at the checkpoint, dropping the lines written after it by a run
+        which stopped. Checkpoints written without the size leave the file as it is.
+        """
+        results_bytes = self.checkpoint.get("results_bytes", None if self.checkpoint else 0)
+        if results_bytes is not None and self.results_file.tell() > results_bytes:
+            LOG.info("Dropping the results written after the checkpoint of %s", self.results_path)
+            self.results_file.truncate(results_bytes)
+
+    def record(self, vin, status, reason=None):
+        """
+        Appends the outcome of a VIN to the results file
+        :param vin: string
+        :param status: converted, failed, not_found, unsupported or already_us
+        :param reason: string, details of the outcome
+        """
+        with self.lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+            self.results_file.write(json.dumps({"vin": vin, "status": status, "reason": reason}) + "\n")
+
+    def save(self, records_done):
+        """
+        Writes the checkpoint
+        :param records_done: int, number of leading records whose outcome is in the results file
+        """
+        with self.lock:
+            self.results_file.flush()
+            self.checkpoint = {"input": os.path.abspath(self.input_path), "records_done": records_done,
+                               "counts": dict(self.counts), "results_bytes": self.results_file.tell()}
+            save_checkpoint(self.checkpoint_path, self.checkpoint)
+
+    def print_progress(self, records_done):
+        """
+        Prints the records done, the VINs/sec of this run and the ETA
+        :param records_done: int
+        """
+        elapsed = time.monotonic() - self.started_at
+        rate = (records_done - self.first_record) / elapsed if elapsed else 0
+        eta = (self.total - records_done) / rate if rate else None
+        counts = ", ".join(f"{count} {status}" for status, count in sorted(self.counts.items()))
+        print(f"{records_done}/{self.total} records ({counts}), {rate:.1f} VINs/sec, "
+              f"ETA {time.strftime('%H:%M:%S', time.gmtime(eta)) if eta is not None else '-'}", flush=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline CA to US conversion of a CSV or JSONL VIN file")
+    parser.add_argument("input", help="CSV file with a vin column (or the VIN first) or JSONL file with a vin key")
+    parser.add_argument("--stage", default=os.getenv("stage", "TEST").upper(), choices=["TEST", "PROD"],
+                        help="batch server and CVP_<stage> database sections of ca_to_us.ini")
+    parser.add_argument("--chunk-size", type=int, default=batch_pipeline.PIPELINE_CHUNK_SIZE,
+                        help="VINs per remote batch run")
+    parser.add_argument("--prefilter-size", type=int, default=dao.BULK_CHUNK_SIZE, help="VINs per VEHICLE query")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint file, <input>.checkpoint.json by default")
+    parser.add_argument("--results", default=None, help="JSONL results file, <input>.results.jsonl by default")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start from the first VIN")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    log_setup.configure()
+    args = parse_args(argv)
+    conversion = BulkConversion(args.input, args.stage, args.checkpoint, args.results, args.chunk_size,
+                                args.prefilter_size, args.restart)
+    return conversion.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,22 @@
-# -*- coding: utf-8 -*-
-
-import os
-
-
-ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
-
-filetowrite_vin = "/tmp/Destination-CA-US-panaupdate-query.txt"
-file_path = "/clocal/CVP/batch/SiriusXMCV/Destination-CA-to-US/input/Destination-CA-US-panaupdate-query.txt"
\ No newline at end of file
+# -*- coding: utf-8 -*-
+
+import os
+import configparser
+from functools import lru_cache
+
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+file_path = "/clocal/CVP/batch/SiriusXMCV/Destination-CA-to-US/input/Destination-CA-US-panaupdate-query.txt"
+ini_file = os.path.join(ROOT_DIR, "ca_to_us.ini")
+
+
+@lru_cache(maxsize=None)
+def get_config():
+    """
+    Parses ca_to_us.ini once, on the first call
+    :return ConfigParser
+    """
+    config_parser = configparser.ConfigParser()
+    config_parser.read(ini_file)
+    return config_parser
@@ -1,119 +1,558 @@
-import ibm_db
-import configparser
-import logging
-from paramiko import SSHClient
-import paramiko
-import os
-import time
-from functools import wraps
-import kms_decrypt
-
-config_parser = configparser.ConfigParser()
-config_parser.read('ca_to_us.ini')
-
-logLevel = (os.getenv("logLevel", "INFO")).upper()
-logging.basicConfig(level=logging.INFO if logLevel == "INFO" else logging.ERROR, datefmt='%H:%M:%S',
-                    format='%(levelname)s: %(module)s:%(funcName)s:%(lineno)d: %(asctime)s: %(message)s')
-LOG = logging.getLogger(__name__)
-
-
-def retry(ExceptionToCheck, tries=4, delay=3, backoff=2, logger=None):
-    """Retry calling the decorated function using an exponential backoff.
-
-    http://www.saltycrane.com/blog/2009/11/trying-out-retry-decorator-python/
-    original from: http://wiki.python.org/moin/PythonDecoratorLibrary#Retry
-
-    :param ExceptionToCheck: the exception to check. may be a tuple of
-        exceptions to check
-    :type ExceptionToCheck: Exception or tuple
-    :param tries: number of times to try (not retry) before giving up
-    :type tries: int
-    :param delay: initial delay between retries in seconds
-    :type delay: int
-    :param backoff: backoff multiplier e.g. value of 2 will double the delay
-        each retry
-    :type backoff: int
-    :param logger: logger to use. If None, print
-    :type logger: logging.Logger instance
-    """
-    def deco_retry(f):
-        @wraps(f)
-        def f_retry(*args, **kwargs):
-            mtries, mdelay = tries, delay
-            while mtries > 1:
-                try:
-                    return f(*args, **kwargs)
-                except ExceptionToCheck as e:
-                    msg = "%s, Retrying in %d seconds..." % (str(e), mdelay)
-                    LOG.warning(msg)
-                    time.sleep(mdelay)
-                    mtries -= 1
-                    mdelay *= backoff
-            return f(*args, **kwargs)
-
-        return f_retry  # true decorator
-
-    return deco_retry
-
-
-@retry(Exception, tries=3)
-def server_connection(server=None):
-    """
-    Establishes the server connection.
-
-    :param server: String, name of server
-    :return connection_flag: boolean
-    :return client: object
-    """
-
-    assert server is not None, "Provide a server name"
-
-    LOG.info("Trying to establish connection with  Server...")
-    host_name = config_parser[server]['server']
-    user_name = kms_decrypt.decrypt(os.environ.get("username"))
-    password = kms_decrypt.decrypt(os.environ.get("password"))
-    client = SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    client.load_system_host_keys()
-    connection_flag = 0
-    try:
-        client.connect(host_name, username=user_name, password=password)
-        connection_flag = 1
-        LOG.info(f"Connection established with {server} server")
-    except Exception as e:
-        LOG.error(f"Connection not established with {server} server")
-        raise Exception(f"Connection not established with {server} server. Error : {str(e)}")
-    finally:
-        return connection_flag, client
-
-
-@retry(Exception, tries=3)
-def database_connection(db=None):
-    """
-    Establishes the connection to database
-    :param db: string, name of database
-    :return connection object
-    """
-
-    assert db is not None, "Please provide the name of Database"
-
-    LOG.info(f"Establishing connection with {db} database...")
-    try:
-        uid = kms_decrypt.decrypt(os.environ.get("CVP_username"))
-        password = kms_decrypt.decrypt(os.environ.get("CVP_password"))
-
-        connection = ibm_db.connect("DATABASE=" + config_parser[db]['database'] + ";Instance=" + config_parser[db]['instance'] + ";HOSTNAME=" + config_parser[db]['hostname'] + ";PORT=" + config_parser[db]['port'] + ";PROTOCOL=" + config_parser[db]['protocol'] + ";UID=" + uid + ";PWD=" + password + ";", "", "")
-        LOG.info(f"Connected to {db} database")
-        return connection
-    except Exception as e:
-        LOG.error(f"Connection not established with {db} database. Error  : {str(e)}")
-        raise Exception(f"Connection not established with {db} database. Error  : {str(e)}")
-        
-def close_connection(db_connection):
-    """
-    Closes the database connection.
-
-    :param db_connection: ibm_db connect object
-    :return ibm_db close
-    """
-    ibm_db.close(db_connection)
+import logging
+import os
+import random
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+import config
+import kms_decrypt
+import dao
+import tracing
+
+LOG = logging.getLogger(__name__)
+
+DB_CONNECTION_REUSE = os.getenv("db_connection_reuse", "true").lower() == "true"
+DB_CONNECTION_MAX_IDLE = int(os.getenv("db_connection_max_idle", 300))
+HEALTH_CHECK_QUERY = "SELECT 1 FROM SYSIBM.SYSDUMMY1"
+SSH_SESSION_REUSE = os.getenv("ssh_session_reuse", "true").lower() == "true"
+SSH_KEEPALIVE_INTERVAL = int(os.getenv("ssh_keepalive_interval", 30))
+SSH_CONNECT_TIMEOUT = float(os.getenv("ssh_connect_timeout", 15))
+SSH_CHECK_TIMEOUT = float(os.getenv("ssh_check_timeout", 5))
+SPECULATIVE_SETUP = os.getenv("speculative_setup", "false").lower() == "true"
+RETRY_TRIES = int(os.getenv("retry_tries", 3))
+RETRY_DELAY = float(os.getenv("retry_delay", 3))
+RETRY_MAX_DELAY = float(os.getenv("retry_max_delay", 20))
+RETRY_DEADLINE_MARGIN = float(os.getenv("retry_deadline_margin", 30))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("breaker_failure_threshold", 5))
+BREAKER_RESET_TIMEOUT = float(os.getenv("breaker_reset_timeout", 60))
+DB2_AUTHENTICATION_ERROR = "SQL30082N"
+
+
+class AuthenticationError(Exception):
+    """The target refused the credentials, retrying with the same ones cannot succeed"""
+
+
+class CircuitOpenError(Exception):
+    """The target failed repeatedly and calls are refused until the breaker resets"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker of one target, shared by all the invocations of the container"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, target, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.target = target
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Refuses the call while the breaker is open, lets a single trial call through once reset_timeout elapsed
+        and refuses the other calls until the trial ends
+        :return boolean, whether the call is the trial call
+        """
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError(f"Circuit open for {self.target} after {self.failures} failures")
+                LOG.info("Circuit half-open for %s, trying again", self.target)
+                self.state = self.HALF_OPEN
+            elif self.state == self.HALF_OPEN:
+                if self.trial_in_flight:
+                    raise CircuitOpenError(f"Circuit half-open for {self.target}, trial call in progress")
+            else:
+                return False
+            self.trial_in_flight = True
+            return True
+
+    def end_trial(self):
+        """Ends a trial call which neither succeeded nor failed, e.g. refused credentials"""
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                LOG.info("Circuit closed for %s", self.target)
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    LOG.error("Circuit open for %s after %s failures", self.target, self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def is_open(self):
+        return self.state == self.OPEN
+
+
+circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+_deadline = None
+
+
+def get_circuit_breaker(target):
+    """
+    :param target: string, name of the target e.g. database_connection:CVP_PROD
+    :return CircuitBreaker of the target
+    """
+    with _circuit_breakers_lock:
+        if target not in circuit_breakers:
+            circuit_breakers[target] = CircuitBreaker(target)
+        return circuit_breakers[target]
+
+
+def set_deadline(context=None):
+    """
+    Bounds the retries of the current invocation by the remaining lambda time
+    :param context: lambda context, no bound when None
+    """
+    global _deadline
+    if context is None:
+        _deadline = None
+    else:
+        _deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - RETRY_DEADLINE_MARGIN
+
+
+def remaining_time():
+    """
+    :return float, seconds left for retries in the current invocation, None when unbounded
+    """
+    if _deadline is None:
+        return None
+    return _deadline - time.monotonic()
+
+
+class RetryPolicy:
+    """Retry with exponential backoff and jitter, within the invocation time budget and behind a circuit breaker.
+    Used as a decorator, the breaker target is the function name and its first argument."""
+
+    def __init__(self, exceptions=Exception, tries=RETRY_TRIES, delay=RETRY_DELAY, backoff=2,
+                 max_delay=RETRY_MAX_DELAY, jitter=0.5, non_retryable=(AssertionError, AuthenticationError)):
+        """
+        :param exceptions: exception or tuple of exceptions to retry
+        :param tries: number of times to try (not retry) before giving up
+        :param delay: initial delay between retries in seconds
+        :param backoff: backoff multiplier of the delay
+        :param max_delay: maximum delay between retries in seconds
+        :param jitter: fraction of the delay that is randomized
+        :param non_retryable: exceptions raised immediately and not counted by the breaker
+        """
+        self.exceptions = exceptions
+        self.tries = tries
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.non_retryable = non_retryable
+
+    def __call__(self, f):
+        @wraps(f)
+        def f_retry(*args, **kwargs):
+            target = f.__name__ + ":" + str(args[0] if args else next(iter(kwargs.values()), ""))
+            return self.call(target, f, *args, **kwargs)
+
+        return f_retry
+
+    def call(self, target, f, *args, **kwargs):
+        """
+        Calls f, retrying the failures
+        :param target: string, name of the circuit breaker
+        :param f: function to call
+        :return result of f
+        """
+        breaker = get_circuit_breaker(target)
+        trial = breaker.before_call()
+        attempt = 1
+        delay = self.delay
+        while True:
+            try:
+                result = f(*args, **kwargs)
+            except self.non_retryable:
+                if trial:
+                    breaker.end_trial()
+                raise
+            except self.exceptions as e:
+                breaker.record_failure()
+                if attempt >= self.tries or breaker.is_open():
+                    raise
+                sleep_for = random.uniform(delay * (1 - self.jitter), delay)
+                remaining = remaining_time()
+                if remaining is not None and sleep_for >= remaining:
+                    LOG.warning("%s, no time left to retry", e)
+                    raise
+                LOG.warning("%s, Retrying in %.1f seconds...", e, sleep_for)
+                time.sleep(sleep_for)
+                attempt += 1
+                delay = min(delay * self.backoff, self.max_delay)
+            else:
+                breaker.record_success()
+                return result
+
+
+@tracing.traced("ssh_connect")
+@RetryPolicy()
+def server_connection(server=None):
+    """
+    Establishes the server connection.
+
+    :param server: String, name of server
+    :return connection_flag: boolean
+    :return client: object
+    """
+
+    assert server is not None, "Provide a server name"
+
+    import paramiko
+
+    LOG.info("Trying to establish connection with  Server...")
+    config_parser = config.get_config()
+    host_name = config_parser[server]['server']
+    user_name = kms_decrypt.get_secret("username")
+    password = kms_decrypt.get_secret("password")
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.load_system_host_keys()
+    connection_flag = 0
+    try:
+        client.connect(host_name, port=int(config_parser[server].get('port', 22)), username=user_name,
+                       password=password, timeout=SSH_CONNECT_TIMEOUT)
+        connection_flag = 1
+        LOG.info("Connection established with %s server", server)
+    except paramiko.AuthenticationException as e:
+        LOG.error("Authentication failed with %s server", server)
+        kms_decrypt.invalidate(["username", "password"])
+        raise AuthenticationError(f"Authentication failed with {server} server. Error : {str(e)}")
+    except Exception as e:
+        LOG.error("Connection not established with %s server", server)
+        raise Exception(f"Connection not established with {server} server. Error : {str(e)}")
+    return connection_flag, client
+
+
+@tracing.traced("db_connect")
+@RetryPolicy()
+def database_connection(db=None):
+    """
+    Establishes the connection to database
+    :param db: string, name of database
+    :return connection object
+    """
+
+    assert db is not None, "Please provide the name of Database"
+
+    import ibm_db
+
+    LOG.info("Establishing connection with %s database...", db)
+    try:
+        config_parser = config.get_config()
+        uid = kms_decrypt.get_secret("CVP_username")
+        password = kms_decrypt.get_secret("CVP_password")
+
+        connection = ibm_db.connect("DATABASE=" + config_parser[db]['database'] + ";Instance=" + config_parser[db]['instance'] + ";HOSTNAME=" + config_parser[db]['hostname'] + ";PORT=" + config_parser[db]['port'] + ";PROTOCOL=" + config_parser[db]['protocol'] + ";UID=" + uid + ";PWD=" + password + ";", "", "")
+        LOG.info("Connected to %s database", db)
+        return connection
+    except Exception as e:
+        LOG.error("Connection not established with %s database. Error  : %s", db, e)
+        if DB2_AUTHENTICATION_ERROR in str(e):
+            kms_decrypt.invalidate(["CVP_username", "CVP_password"])
+            raise AuthenticationError(f"Authentication failed with {db} database. Error  : {str(e)}")
+        raise Exception(f"Connection not established with {db} database. Error  : {str(e)}")
+        
+def close_connection(db_connection):
+    """
+    Closes the database connection.
+
+    :param db_connection: ibm_db connect object
+    :return ibm_db close
+    """
+    import ibm_db
+
+    dao.release_statement_cache(db_connection)
+    ibm_db.close(db_connection)
+
+
+class DatabaseConnectionHolder:
+    """Keeps the DB2 connections alive across the invocations of a warm container"""
+
+    def __init__(self, max_idle=DB_CONNECTION_MAX_IDLE):
+        self.max_idle = max_idle
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, db):
+        """
+        Returns a live connection to the database, reconnecting when the kept one is idle for too long or stale
+        :param db: string, name of database
+        :return connection object
+        """
+        with self.lock:
+            entry = self.connections.pop(db, None)
+            if entry is not None:
+                connection, last_used = entry
+                if time.monotonic() - last_used > self.max_idle:
+                    LOG.info("Connection to %s database idle for too long, reconnecting...", db)
+                    discard_connection(connection)
+                elif is_connection_alive(connection):
+                    LOG.info("Reusing connection to %s database", db)
+                    self.connections[db] = (connection, time.monotonic())
+                    return connection
+                else:
+                    LOG.info("Connection to %s database is stale, reconnecting...", db)
+                    discard_connection(connection)
+            connection = database_connection(db)
+            self.connections[db] = (connection, time.monotonic())
+            return connection
+
+    def release(self, db_connection):
+        """
+        Marks the connection as idle, it stays open for the next invocation
+        :param db_connection: ibm_db connect object
+        """
+        with self.lock:
+            for db, (connection, _) in self.connections.items():
+                if connection is db_connection:
+                    self.connections[db] = (connection, time.monotonic())
+                    return
+        close_connection(db_connection)
+
+    def close_all(self):
+        """Closes all the kept connections"""
+        with self.lock:
+            for connection, _ in self.connections.values():
+                discard_connection(connection)
+            self.connections.clear()
+
+
+@tracing.traced("db_health_check")
+def is_connection_alive(db_connection):
+    """
+    Cheap health check of a DB2 connection
+    :param db_connection: ibm_db connect object
+    :return boolean
+    """
+    import ibm_db
+
+    try:
+        if not ibm_db.active(db_connection):
+            return False
+        statement = ibm_db.exec_immediate(db_connection, HEALTH_CHECK_QUERY)
+        alive = bool(ibm_db.fetch_tuple(statement))
+        ibm_db.free_result(statement)
+        return alive
+    except Exception as e:
+        LOG.warning("Health check of the connection failed : %s", e)
+        return False
+
+
+def discard_connection(db_connection):
+    """
+    Closes a connection, ignoring the errors of an already broken one
+    :param db_connection: ibm_db connect object
+    """
+    try:
+        close_connection(db_connection)
+    except Exception as e:
+        LOG.warning("Problem while closing the connection : %s", e)
+
+
+db_connection_holder = DatabaseConnectionHolder()
+
+
+def get_database_connection(db=None):
+    """
+    Returns a connection to the database, reused across warm invocations unless db_connection_reuse is false
+    :param db: string, name of database
+    :return connection object
+    """
+    if DB_CONNECTION_REUSE:
+        return db_connection_holder.get(db)
+    return database_connection(db)
+
+
+def release_database_connection(db_connection):
+    """
+    Gives back a connection obtained with get_database_connection, closing it when reuse is disabled
+    :param db_connection: ibm_db connect object
+    """
+    if DB_CONNECTION_REUSE:
+        db_connection_holder.release(db_connection)
+    else:
+        close_connection(db_connection)
+
+
+class SSHSession:
+    """SSH connection to a server whose transport is shared by the SFTP and exec channels and kept across
+    warm invocations"""
+
+    def __init__(self, server):
+        self.server = server
+        self.client = None
+        self.sftp = None
+        self.reused = False
+        self.lock = threading.Lock()
+        self.stats = {"connects": 0, "reuses": 0, "last_connect_seconds": None, "total_connect_seconds": 0.0}
+
+    def ensure(self):
+        """
+        Validates the session and reconnects when the transport is gone
+        :return client: paramiko SSHClient
+        """
+        with self.lock:
+            self.reused = self.is_alive()
+            if self.reused:
+                self.stats["reuses"] += 1
+                LOG.info("Reusing SSH session with %s server", self.server)
+                return self.client
+            self.close()
+            start = time.monotonic()
+            connection_flag, client = server_connection(self.server)
+            if connection_flag == 0:
+                raise Exception(f"Connection not established with {self.server} server")
+            elapsed = time.monotonic() - start
+            self.stats["connects"] += 1
+            self.stats["last_connect_seconds"] = elapsed
+            self.stats["total_connect_seconds"] += elapsed
+            LOG.info("SSH session with %s server established in %.3f seconds", self.server, elapsed)
+            client.get_transport().set_keepalive(SSH_KEEPALIVE_INTERVAL)
+            self.client = client
+            return client
+
+    def is_alive(self):
+        """
+        Checks that the server still answers on the session with an SFTP stat, bounded by ssh_check_timeout.
+        A connection dropped by the server or a NAT while the container was frozen looks active locally
+        until a request goes through it.
+        :return boolean
+        """
+        if self.client is None:
+            return False
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            channel = self.get_sftp().get_channel()
+            channel.settimeout(SSH_CHECK_TIMEOUT)
+            try:
+                self.sftp.stat(".")
+            finally:
+                channel.settimeout(None)
+            return True
+        except Exception as e:
+            LOG.warning("SSH session with %s server is broken : %s", self.server, e)
+            return False
+
+    def get_sftp(self):
+        """
+        Gives the SFTP channel of the connected session, opened on the first use
+        :return paramiko SFTPClient
+        """
+        if self.sftp is None or self.sftp.get_channel().closed:
+            self.sftp = self.client.open_sftp()
+        return self.sftp
+
+    def close(self):
+        """Closes the SFTP channel and the connection"""
+        if self.sftp is not None:
+            try:
+                self.sftp.close()
+            except Exception as e:
+                LOG.warning("Problem while closing SFTP channel : %s", e)
+            self.sftp = None
+        if self.client is not None:
+            LOG.info("Closing client connection...")
+            self.client.close()
+            LOG.info("Client connection closed")
+            self.client = None
+
+
+ssh_sessions = {}
+_ssh_sessions_lock = threading.Lock()
+
+
+def get_ssh_session(server=None):
+    """
+    Gives a connected SSH session to the server, kept across warm invocations unless ssh_session_reuse is false
+    :param server: String, name of server
+    :return SSHSession
+    """
+    assert server is not None, "Provide a server name"
+
+    if not SSH_SESSION_REUSE:
+        session = SSHSession(server)
+    else:
+        with _ssh_sessions_lock:
+            session = ssh_sessions.setdefault(server, SSHSession(server))
+    session.ensure()
+    return session
+
+
+def release_ssh_session(session, broken=False):
+    """
+    Gives back a session obtained with get_ssh_session, closing it when reuse is disabled or it is broken
+    :param session: SSHSession
+    :param broken: boolean, whether an error left the session in an unknown state
+    """
+    if broken or not SSH_SESSION_REUSE:
+        with session.lock:
+            session.close()
+
+
+_setup_executor = None
+
+
+def start_ssh_setup(server=None):
+    """
+    Connects the kept SSH session to the server in the background, so that the KMS decrypts and the handshake
+    overlap with the work done before the batch. The session is left in ssh_sessions for get_ssh_session.
+    :param server: String, name of server
+    :return Future resolving to whether the session is ready, None when sessions are not reused
+    """
+    global _setup_executor
+    assert server is not None, "Provide a server name"
+
+    if not SSH_SESSION_REUSE:
+        LOG.info("SSH sessions are not reused, no speculative setup")
+        return None
+    with _ssh_sessions_lock:
+        if _setup_executor is None:
+            _setup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ssh-setup")
+    return _setup_executor.submit(prepare_ssh_session, server)
+
+
+def prepare_ssh_session(server):
+    """
+    Connects the kept SSH session to the server, or validates it when it is already connected
+    :param server: String, name of server
+    :return boolean, whether the session is ready
+    """
+    try:
+        release_ssh_session(get_ssh_session(server))
+        return True
+    except Exception as e:
+        LOG.warning("Speculative SSH setup with %s server failed : %s", server, e)
+        return False
+
+
+def cancel_ssh_setup(setup):
+    """
+    Drops a speculative setup which turned out to be useless. A setup not started yet is cancelled, a running one
+    completes in the background and its session stays kept for the next invocation.
+    :param setup: Future given by start_ssh_setup, or None
+    """
+    if setup is not None and setup.cancel():
+        LOG.info("Speculative SSH setup cancelled")
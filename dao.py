@@ -1,93 +1,352 @@
-import ibm_db
-import logging
-import os
-
-US = "US"
-CA = "CA"
-
-logLevel = (os.getenv("logLevel", "INFO")).upper()
-
-logging.basicConfig(
-    level=logging.INFO if logLevel == "INFO" else logging.ERROR,
-    datefmt="%H:%M:%S",
-    format="%(levelname)s: %(module)s:%(funcName)s:%(lineno)d: %(asctime)s: %(message)s",
-)
-LOG = logging.getLogger(__name__)
-
-
-
-
-def check_vehicle_table_for_conversion(db_connection=None, vin=None):
-    """
-    Check if the conversion is done in database by the batch
-    :param db_connection: ibm_db connect object
-    :param vin: string, vin to be processed
-    :return boolean
-    """
-
-    assert db_connection is not None, "Connection not established"
-    assert vin is not None, "Please provide proper VIN"
-
-    LOG.info("Checking the destination country for VIN " + vin)
-
-    vehicle_query = f"Select N_DEST_CNTRY from CVP.VEHICLE  WHERE I_VIN = ('{vin}')"
-    vehicle_result = search_database(db_connection, vehicle_query)
-    vehicle_cnty = vehicle_result[0].replace(" ","")
-    if vehicle_cnty == US:
-        LOG.info("The destination country is: " + vehicle_cnty)
-        return  True
-       
-    elif vehicle_cnty == CA:
-        LOG.info("The destination country is : " + vehicle_cnty)
-        return False
-        
-    
-
-
-def check_vehicle_table(db_connection=None, vin=None):
-    """Checks if the vin is present in VEHICLE table and if the vehicle is TBM or VP4R
-    :param db_connection: ibm_db connect object
-    :param vin: string, vin to be processed
-    :return boolean
-    """
-    assert db_connection is not None, "Connection not established"
-    assert vin is not None, "Please provide proper VIN"
-
-    isTBM = False
-    isVP4R = False
-
-    LOG.info("Checking VIN " + vin + " in VEHICLE table...")
-    vehicle_query = f"SELECT C_VHCL_TYP from CVP.VEHICLE where I_VIN in ('{vin}') with ur"
-    LOG.info("vehicle_query")
-    vehicle_result = search_database(db_connection, vehicle_query)
-    if vehicle_result :
-        vehicle_name = vehicle_result[0].replace(" ","")
-        if vehicle_name == "CVP_TBM":
-            LOG.info("Vin " + vin + " found in VEHICLE table and is TBM")
-            isTBM = True
-            return True,isTBM,isVP4R
-        elif vehicle_name == "CVP_SXM":
-            LOG.info("Vin " + vin + " found in VEHICLE table and is VP4R")
-            isVP4R = True
-            return True,isTBM,isVP4R
-        else:
-            LOG.info("Vin " + vin + " found in VEHICLE table and is neither TBM nor VP4R")
-            return True,isTBM,isVP4R
-    else:
-        LOG.info("Vin " + vin + " not found in vehicle table. please check vin again .")
-        return False,isTBM,isVP4R
-    
-            
-def search_database(db_connection=None, sql_query=None):
-    """Used to execute Query.
-
-    :param db_connection: ibm_db connect object
-    :param sql_query: string, sql query
-    :return result of query
-    """
-    assert db_connection is not None, "Connection not established"
-    assert sql_query is not None, "No query provided"
-
-    execute_query = ibm_db.exec_immediate(db_connection, sql_query)
-    result = ibm_db.fetch_tuple(execute_query)
-    return result
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import tracing
+
+US = "US"
+CA = "CA"
+TBM = "TBM"
+VP4R = "VP4R"
+VEHICLE_TYPES = {"CVP_TBM": TBM, "CVP_SXM": VP4R}
+
+LOG = logging.getLogger(__name__)
+
+BULK_CHUNK_SIZE = int(os.getenv("vehicle_bulk_chunk_size", 500))
+VEHICLE_TYPE_CACHE_SIZE = int(os.getenv("vehicle_type_cache_size", 50000))
+VEHICLE_TYPE_CACHE_TTL = int(os.getenv("vehicle_type_cache_ttl", 86400))
+IN_LIST_SIZES = sorted(int(size) for size in os.getenv("in_list_sizes", "1,10,50,100,500").split(","))
+STATEMENT_CACHE_SIZE = int(os.getenv("statement_cache_size", 32))
+
+
+class VehicleTypeCache:
+    """Bounded LRU cache of VIN -> C_VHCL_TYP with a time to live, in front of the reads of iter_vehicle_details.
+    Only the vehicle type is kept, the destination country is what the batch changes and is always read.
+    Hits, misses and evictions are counted in the EMF record of the invocation."""
+
+    def __init__(self, max_size=VEHICLE_TYPE_CACHE_SIZE, ttl=VEHICLE_TYPE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, vin):
+        """
+        :param vin: string
+        :return cached vehicle type, None on a miss
+        """
+        with self.lock:
+            entry = self.entries.get(vin)
+            if entry is not None and entry[1] <= time.monotonic():
+                del self.entries[vin]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(vin)
+                self.hits += 1
+        tracing.increment("vehicle_type_cache_misses" if entry is None else "vehicle_type_cache_hits")
+        return entry[0] if entry is not None else None
+
+    def put(self, vin, vehicle_type):
+        """
+        :param vin: string
+        :param vehicle_type: string, C_VHCL_TYP value
+        """
+        if self.max_size <= 0 or vehicle_type is None:
+            return
+        evicted = 0
+        with self.lock:
+            self.entries[vin] = (vehicle_type, time.monotonic() + self.ttl)
+            self.entries.move_to_end(vin)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                evicted += 1
+            self.evictions += evicted
+        if evicted:
+            tracing.increment("vehicle_type_cache_evictions", evicted)
+
+    def stats(self):
+        """
+        :return dict with size, hits, misses, evictions and expirations
+        """
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions, "expirations": self.expirations}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+vehicle_type_cache = VehicleTypeCache()
+
+
+def iter_vehicle_details(db_connection=None, vins=None, chunk_size=BULK_CHUNK_SIZE):
+    """Streams the vehicle type and destination country of many VINs using chunked IN-list queries.
+    When all the VINs of a chunk are in vehicle_type_cache only their destination country is read, otherwise the
+    chunk is read in full with one query.
+    :param db_connection: ibm_db connect object
+    :param vins: iterable of vins to be processed
+    :param chunk_size: int, number of vins per query
+    :return generator of tuples (vin, vehicle_type, destination_country) for the vins found in VEHICLE table
+    """
+    assert db_connection is not None, "Connection not established"
+    assert vins is not None, "Please provide proper VINs"
+    assert chunk_size > 0, "Chunk size must be positive"
+
+    for chunk in chunked(vins, chunk_size):
+        cached_types = {}
+        for vin in chunk:
+            vehicle_type = vehicle_type_cache.get(vin)
+            if vehicle_type is None:
+                break
+            cached_types[vin] = vehicle_type
+        if len(cached_types) == len(set(chunk)):
+            for vin, country in read_destination_countries(db_connection, chunk):
+                yield vin, cached_types[vin], country
+            continue
+        LOG.info("Reading %s VINs from VEHICLE table...", len(chunk))
+        params = in_list(chunk)
+        vehicle_query = f"SELECT I_VIN, C_VHCL_TYP, N_DEST_CNTRY from CVP.VEHICLE where I_VIN in ({placeholders(len(params))})"
+        for row in iter_search_database(db_connection, vehicle_query, params):
+            vin, vehicle_type = strip_value(row[0]), strip_value(row[1])
+            vehicle_type_cache.put(vin, vehicle_type)
+            yield vin, vehicle_type, strip_value(row[2])
+
+
+def iter_destination_countries(db_connection=None, vins=None, chunk_size=BULK_CHUNK_SIZE):
+    """Streams the destination country of many VINs using chunked IN-list queries
+    :param db_connection: ibm_db connect object
+    :param vins: iterable of vins to be processed
+    :param chunk_size: int, number of vins per query
+    :return generator of tuples (vin, destination_country) for the vins found in VEHICLE table
+    """
+    assert db_connection is not None, "Connection not established"
+    assert vins is not None, "Please provide proper VINs"
+    assert chunk_size > 0, "Chunk size must be positive"
+
+    for chunk in chunked(vins, chunk_size):
+        yield from read_destination_countries(db_connection, chunk)
+
+
+def read_destination_countries(db_connection, vins):
+    """Reads the destination country of the VINs with one IN-list query, the destination country is never cached
+    since it is what the batch changes
+    :param db_connection: ibm_db connect object
+    :param vins: list of vins
+    :return generator of tuples (vin, destination_country)
+    """
+    LOG.info("Reading destination country of %s VINs from VEHICLE table...", len(vins))
+    params = in_list(vins)
+    vehicle_query = f"SELECT I_VIN, N_DEST_CNTRY from CVP.VEHICLE where I_VIN in ({placeholders(len(params))})"
+    for row in iter_search_database(db_connection, vehicle_query, params):
+        yield strip_value(row[0]), strip_value(row[1])
+
+
+def classify_vehicle_type(vehicle_type):
+    """Maps the C_VHCL_TYP of VEHICLE table to TBM or VP4R
+    :param vehicle_type: string, C_VHCL_TYP value
+    :return TBM, VP4R or None when the vehicle is neither
+    """
+    return VEHICLE_TYPES.get(vehicle_type)
+
+
+def chunked(values, chunk_size):
+    """Splits an iterable into lists of at most chunk_size elements
+    :param values: iterable
+    :param chunk_size: int
+    :return generator of lists
+    """
+    chunk = []
+    for value in values:
+        chunk.append(value)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def placeholders(count):
+    """Builds the parameter markers of an IN-list
+    :param count: int, number of values in the IN-list
+    :return string
+    """
+    return ", ".join("?" * count)
+
+
+def in_list(values):
+    """Pads the values of an IN-list to the next size of in_list_sizes by repeating the last one, so that
+    the queries of any number of VINs share a few statement templates
+    :param values: non-empty list of values
+    :return list of values, the list itself when it is longer than the largest size
+    """
+    size = next((size for size in IN_LIST_SIZES if size >= len(values)), len(values))
+    return values + [values[-1]] * (size - len(values))
+
+
+def strip_value(value):
+    """Removes the blank padding of CHAR columns
+    :param value: column value
+    :return string or None
+    """
+    return value.replace(" ", "") if value is not None else None
+
+
+class StatementCache:
+    """Prepared statements of one connection, keyed by query template.
+    Bounded LRU, the least recently used statement is freed when the cache is full."""
+
+    def __init__(self, db_connection, max_size=STATEMENT_CACHE_SIZE):
+        self.db_connection = db_connection
+        self.max_size = max_size
+        self.statements = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, sql_query):
+        """Returns the prepared statement of the query, preparing it on the first use
+        :param sql_query: string, sql query with ? parameter markers
+        :return ibm_db statement
+        """
+        import ibm_db
+
+        statement = self.statements.get(sql_query)
+        if statement is None:
+            self.misses += 1
+            STATEMENT_CACHE_STATS["misses"] += 1
+            statement = ibm_db.prepare(self.db_connection, sql_query)
+            if not statement:
+                raise Exception(f"Statement could not be prepared. Error : {ibm_db.stmt_errormsg()}")
+            self.statements[sql_query] = statement
+            while len(self.statements) > max(self.max_size, 1):
+                _, evicted = self.statements.popitem(last=False)
+                self.evictions += 1
+                STATEMENT_CACHE_STATS["evictions"] += 1
+                free_statement(evicted)
+        else:
+            self.statements.move_to_end(sql_query)
+            self.hits += 1
+            STATEMENT_CACHE_STATS["hits"] += 1
+        return statement
+
+    def clear(self):
+        """Frees all the prepared statements of the connection"""
+        for statement in self.statements.values():
+            free_statement(statement)
+        self.statements.clear()
+
+
+def free_statement(statement):
+    """Frees a prepared statement
+    :param statement: ibm_db statement
+    """
+    import ibm_db
+
+    try:
+        ibm_db.free_stmt(statement)
+    except Exception as e:
+        LOG.warning("Problem while freeing statement : %s", e)
+
+
+STATEMENT_CACHE_STATS = {"hits": 0, "misses": 0, "evictions": 0}
+_statement_caches = {}
+
+
+def get_statement_cache(db_connection):
+    """Returns the prepared-statement cache of a connection
+    :param db_connection: ibm_db connect object
+    :return StatementCache
+    """
+    cache = _statement_caches.get(id(db_connection))
+    if cache is None or cache.db_connection is not db_connection:
+        cache = StatementCache(db_connection)
+        _statement_caches[id(db_connection)] = cache
+    return cache
+
+
+def release_statement_cache(db_connection):
+    """Frees the prepared statements of a connection, to be called before closing it
+    :param db_connection: ibm_db connect object
+    """
+    cache = _statement_caches.pop(id(db_connection), None)
+    if cache is not None:
+        cache.clear()
+
+
+def statement_cache_stats():
+    """Counters of the prepared-statement caches
+    :return dict with hits, misses, evictions and the number of cached statements
+    """
+    stats = dict(STATEMENT_CACHE_STATS)
+    stats["statements"] = sum(len(cache.statements) for cache in _statement_caches.values())
+    return stats
+
+
+@tracing.traced("db_query")
+def execute_query(db_connection, sql_query, params=None):
+    """Runs the query, through the prepared-statement cache when parameters are given
+    :param db_connection: ibm_db connect object
+    :param sql_query: string, sql query
+    :param params: sequence of values bound to the ? parameter markers
+    :return ibm_db statement holding the result
+    """
+    import ibm_db
+
+    if params is None:
+        return ibm_db.exec_immediate(db_connection, sql_query)
+    statement = get_statement_cache(db_connection).get(sql_query)
+    ibm_db.execute(statement, tuple(params))
+    return statement
+
+
+def search_database(db_connection=None, sql_query=None, params=None):
+    """Used to execute Query.
+
+    :param db_connection: ibm_db connect object
+    :param sql_query: string, sql query
+    :param params: sequence of values bound to the ? parameter markers of the query
+    :return result of query
+    """
+    assert db_connection is not None, "Connection not established"
+    assert sql_query is not None, "No query provided"
+
+    import ibm_db
+
+    statement = execute_query(db_connection, sql_query, params)
+    result = ibm_db.fetch_tuple(statement)
+    if params is not None:
+        ibm_db.free_result(statement)
+    return result
+
+
+def iter_search_database(db_connection=None, sql_query=None, params=None):
+    """Used to execute Query and stream all the rows of the result.
+
+    :param db_connection: ibm_db connect object
+    :param sql_query: string, sql query
+    :param params: sequence of values bound to the ? parameter markers of the query
+    :return generator of result rows
+    """
+    assert db_connection is not None, "Connection not established"
+    assert sql_query is not None, "No query provided"
+
+    import ibm_db
+
+    statement = execute_query(db_connection, sql_query, params)
+    try:
+        row = ibm_db.fetch_tuple(statement)
+        while row:
+            yield row
+            row = ibm_db.fetch_tuple(statement)
+    finally:
+        ibm_db.free_result(statement)
@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import connections
+import tracing
+
+DISPATCH_REGION = os.getenv("dispatch_region", "us-east-1")
+DISPATCH_MAX_WORKERS = int(os.getenv("dispatch_max_workers", 8))
+DISPATCH_AGGREGATE = os.getenv("dispatch_mode", "single").lower() == "aggregated"
+DISPATCH_MAX_ITEMS = int(os.getenv("dispatch_max_items", 100))
+DISPATCH_RETRY_TRIES = int(os.getenv("dispatch_retry_tries", 5))
+DISPATCH_RETRY_DELAY = float(os.getenv("dispatch_retry_delay", 0.2))
+DISPATCH_RETRY_MAX_DELAY = float(os.getenv("dispatch_retry_max_delay", 5))
+THROTTLING_ERRORS = ("TooManyRequestsException", "ThrottlingException", "Throttling", "RequestLimitExceeded")
+ITEMS = "items"
+
+LOG = logging.getLogger(__name__)
+
+_clients = {}
+_client_lock = threading.Lock()
+_executor = None
+
+
+def client(service_name, region_name=None):
+    """
+    Creates a boto3 client, importing boto3 only when a downstream call is made
+    :param service_name: name of the AWS service
+    :param region_name: AWS region
+    :return: boto3 client
+    """
+    import boto3
+    from botocore.config import Config
+
+    return boto3.client(service_name, region_name=region_name,
+                        config=Config(max_pool_connections=DISPATCH_MAX_WORKERS))
+
+
+def get_client(region_name=DISPATCH_REGION):
+    """
+    Gives the Lambda client of the region, created on the first call and kept for the container
+    :param region_name: AWS region
+    :return: boto3 Lambda client
+    """
+    with _client_lock:
+        if region_name not in _clients:
+            _clients[region_name] = client("lambda", region_name=region_name)
+        return _clients[region_name]
+
+
+def get_executor():
+    """
+    :return ThreadPoolExecutor sending the invocations, bounded to dispatch_max_workers threads
+    """
+    global _executor
+    with _client_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=DISPATCH_MAX_WORKERS, thread_name_prefix="dispatch")
+        return _executor
+
+
+def is_throttling(error):
+    """
+    :param error: exception raised by the Lambda client
+    :return boolean, whether Lambda refused the call because of its rate or concurrency limits
+    """
+    response = getattr(error, "response", None) or {}
+    return response.get("Error", {}).get("Code") in THROTTLING_ERRORS
+
+
+@tracing.traced("lambda_invoke")
+def invoke(function_name, payload, region_name=DISPATCH_REGION):
+    """
+    Invokes a lambda asynchronously, retrying the throttled calls with exponential backoff and jitter
+    within the invocation time budget. Not behind a circuit breaker: a throttled target is slowed down,
+    never skipped.
+    :param function_name: name of the lambda
+    :param payload: JSON-serializable payload, encoded once
+    :param region_name: AWS region
+    :return: response of the Lambda client
+    """
+    data = json.dumps(payload)
+    delay = DISPATCH_RETRY_DELAY
+    attempt = 1
+    while True:
+        try:
+            return get_client(region_name).invoke(FunctionName=function_name, InvocationType="Event", Payload=data)
+        except Exception as e:
+            if not is_throttling(e) or attempt >= DISPATCH_RETRY_TRIES:
+                raise
+            sleep_for = random.uniform(delay / 2, delay)
+            remaining = connections.remaining_time()
+            if remaining is not None and sleep_for >= remaining:
+                LOG.warning("Lambda %s throttled, no time left to retry", function_name)
+                raise
+            LOG.warning("Lambda %s throttled, Retrying in %.2f seconds...", function_name, sleep_for)
+            time.sleep(sleep_for)
+            attempt += 1
+            delay = min(delay * 2, DISPATCH_RETRY_MAX_DELAY)
+
+
+def dispatch(invocations, aggregate=DISPATCH_AGGREGATE, max_items=DISPATCH_MAX_ITEMS):
+    """
+    Sends invocations concurrently from the bounded thread pool.
+    In aggregated mode the payloads of the same lambda are packed into {"items": [...]} payloads of at most
+    max_items payloads, the target lambda has to accept that format.
+    :param invocations: list of (function name, payload)
+    :param aggregate: boolean, pack the payloads per lambda
+    :param max_items: int, maximum number of payloads packed into one invocation
+    :return list of the errors aligned with invocations, None for the sent ones
+    """
+    assert max_items > 0, "Maximum number of items must be positive"
+
+    if aggregate:
+        groups = {}
+        for index, (function_name, _) in enumerate(invocations):
+            groups.setdefault(function_name, []).append(index)
+        calls = []
+        for function_name, indexes in groups.items():
+            for start in range(0, len(indexes), max_items):
+                chunk = indexes[start:start + max_items]
+                calls.append((chunk, function_name, {ITEMS: [invocations[index][1] for index in chunk]}))
+    else:
+        calls = [([index], function_name, payload) for index, (function_name, payload) in enumerate(invocations)]
+
+    errors = [None] * len(invocations)
+    if not calls:
+        return errors
+    with tracing.span("dispatch"):
+        executor = get_executor()
+        futures = [(indexes, function_name, executor.submit(invoke, function_name, payload))
+                   for indexes, function_name, payload in calls]
+        for indexes, function_name, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                LOG.error("Invocation of lambda %s failed : %s", function_name, e)
+                for index in indexes:
+                    errors[index] = e
+    LOG.info("%s payloads sent in %s invocations, %s failed", len(invocations), len(calls),
+             sum(error is not None for error in errors))
+    return errors
@@ -0,0 +1,210 @@
+import abc
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+IDEMPOTENCY_BACKEND = os.getenv("idempotency_backend", "memory").lower()
+IDEMPOTENCY_TTL = int(os.getenv("idempotency_ttl", 3600))
+IDEMPOTENCY_IN_PROGRESS_TTL = int(os.getenv("idempotency_in_progress_ttl", 900))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("idempotency_max_entries", 10000))
+IDEMPOTENCY_DB_PATH = os.getenv("idempotency_db_path", "/tmp/ca_to_us_idempotency.db")
+MEMORY = "memory"
+SQLITE = "sqlite"
+NONE = "none"
+IN_PROGRESS = "in_progress"
+COMPLETED = "completed"
+
+LOG = logging.getLogger(__name__)
+
+
+class IdempotencyStore(abc.ABC):
+    """
+    Interface of the stores keeping the status of each VIN + incident.
+    A shared store (e.g. a DynamoDB table with a conditional put) implements the same three methods.
+    Records are dicts with status, outcome and expires_at (epoch seconds).
+    """
+
+    @abc.abstractmethod
+    def claim(self, key, ttl):
+        """
+        Atomically records the key as in progress unless a live record exists
+        :param key: string
+        :param ttl: int, seconds after which an in-progress record is considered abandoned
+        :return None when the caller owns the key, the existing record otherwise
+        """
+
+    @abc.abstractmethod
+    def complete(self, key, outcome, ttl):
+        """
+        Records the outcome of the key
+        :param key: string
+        :param outcome: JSON-serializable outcome
+        :param ttl: int, seconds during which duplicates get this outcome
+        """
+
+    @abc.abstractmethod
+    def release(self, key):
+        """
+        Drops the record of the key so that the next event runs again
+        :param key: string
+        """
+
+
+class MemoryIdempotencyStore(IdempotencyStore):
+    """LRU store living as long as the warm container"""
+
+    def __init__(self, max_entries=IDEMPOTENCY_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.records = OrderedDict()
+        self.lock = threading.Lock()
+
+    def claim(self, key, ttl):
+        with self.lock:
+            record = self.records.get(key)
+            if record is not None and record["expires_at"] > time.time():
+                self.records.move_to_end(key)
+                return record
+            self.put(key, {"status": IN_PROGRESS, "outcome": None, "expires_at": time.time() + ttl})
+            return None
+
+    def complete(self, key, outcome, ttl):
+        with self.lock:
+            self.put(key, {"status": COMPLETED, "outcome": outcome, "expires_at": time.time() + ttl})
+
+    def release(self, key):
+        with self.lock:
+            self.records.pop(key, None)
+
+    def put(self, key, record):
+        self.records[key] = record
+        self.records.move_to_end(key)
+        while len(self.records) > self.max_entries:
+            self.records.popitem(last=False)
+
+
+class SQLiteIdempotencyStore(IdempotencyStore):
+    """Store in a local SQLite file, shared by the processes of a host and surviving restarts"""
+
+    def __init__(self, path=IDEMPOTENCY_DB_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS idempotency "
+            "(key TEXT PRIMARY KEY, status TEXT NOT NULL, outcome TEXT, expires_at REAL NOT NULL)")
+
+    def claim(self, key, ttl):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute(
+                    "SELECT status, outcome, expires_at FROM idempotency WHERE key = ?", (key,)).fetchone()
+                if row is not None and row[2] > now:
+                    self.connection.execute("COMMIT")
+                    return {"status": row[0], "outcome": json.loads(row[1]) if row[1] else None, "expires_at": row[2]}
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO idempotency VALUES (?, ?, NULL, ?)", (key, IN_PROGRESS, now + ttl))
+                self.connection.execute("COMMIT")
+                return None
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def complete(self, key, outcome, ttl):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO idempotency VALUES (?, ?, ?, ?)",
+                                    (key, COMPLETED, json.dumps(outcome), time.time() + ttl))
+
+    def release(self, key):
+        with self.lock:
+            self.connection.execute("DELETE FROM idempotency WHERE key = ?", (key,))
+
+    def purge_expired(self):
+        """Removes the expired records"""
+        with self.lock:
+            self.connection.execute("DELETE FROM idempotency WHERE expires_at <= ?", (time.time(),))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    Gives the store selected by idempotency_backend, created on the first call
+    :return IdempotencyStore or None when idempotency is disabled
+    """
+    global _store
+    with _store_lock:
+        if _store is None and IDEMPOTENCY_BACKEND != NONE:
+            if IDEMPOTENCY_BACKEND == SQLITE:
+                _store = SQLiteIdempotencyStore()
+            elif IDEMPOTENCY_BACKEND == MEMORY:
+                _store = MemoryIdempotencyStore()
+            else:
+                raise ValueError(f"Unknown idempotency backend {IDEMPOTENCY_BACKEND}")
+        return _store
+
+
+def set_store(store):
+    """
+    Replaces the store, e.g. with a shared store implementation
+    :param store: IdempotencyStore or None to disable idempotency
+    """
+    global _store
+    with _store_lock:
+        _store = store
+
+
+def make_key(vin, incident):
+    """
+    :param vin: string
+    :param incident: string
+    :return string, key of the event
+    """
+    return f"{vin}#{incident}"
+
+
+def claim(vin, incident):
+    """
+    Marks the VIN + incident as in progress
+    :param vin: string
+    :param incident: string
+    :return None when the event has to be processed, the record of the previous event when it is a duplicate
+    """
+    store = get_store()
+    if store is None:
+        return None
+    record = store.claim(make_key(vin, incident), IDEMPOTENCY_IN_PROGRESS_TTL)
+    if record is not None:
+        LOG.info("Duplicate event for VIN %s and incident %s, previous one is %s", vin, incident, record['status'])
+    return record
+
+
+def complete(vin, incident, outcome):
+    """
+    Records the outcome of the VIN + incident for the duplicates to come
+    :param vin: string
+    :param incident: string
+    :param outcome: JSON-serializable outcome
+    """
+    store = get_store()
+    if store is not None:
+        store.complete(make_key(vin, incident), outcome, IDEMPOTENCY_TTL)
+
+
+def release(vin, incident):
+    """
+    Forgets the VIN + incident, so that a retry of the event runs again
+    :param vin: string
+    :param incident: string
+    """
+    store = get_store()
+    if store is not None:
+        store.release(make_key(vin, incident))
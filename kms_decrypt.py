@@ -1,22 +1,118 @@
-import boto3
-import base64
-import os
-
-KMS = "kms"
-
-
-def decrypt(encrypted_value):
-    """
-    Gives decoded and decrypted value 
-    :param encrypted_value: kms encrypted values from environment variables
-    :return: decrypted values
-    """
-    session = boto3.session.Session()
-
-    kms = session.client(KMS)
-
-    encrypted_id = encrypted_value
-    binary_data = base64.b64decode(encrypted_id)
-    meta = kms.decrypt(CiphertextBlob=binary_data)
-    plaintext = meta[u'Plaintext']
-    return plaintext.decode()
+import base64
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+
+KMS = "kms"
+SECRET_CACHE_TTL = int(os.getenv("secret_cache_ttl", 3600))
+SECRET_ENV_NAMES = ("username", "password", "CVP_username", "CVP_password")
+
+_kms_client = None
+_client_lock = threading.Lock()
+_secret_cache = {}
+_cache_lock = threading.Lock()
+_decrypt_lock = threading.Lock()
+
+
+def get_kms_client():
+    """
+    Gives the KMS client of the container, created on the first call
+    :return: boto3 KMS client
+    """
+    global _kms_client
+    with _client_lock:
+        if _kms_client is None:
+            import boto3
+
+            session = boto3.session.Session()
+            _kms_client = session.client(KMS)
+        return _kms_client
+
+
+def decrypt(encrypted_value):
+    """
+    Gives decoded and decrypted value
+    :param encrypted_value: kms encrypted values from environment variables
+    :return: decrypted values
+    """
+    kms = get_kms_client()
+
+    encrypted_id = encrypted_value
+    binary_data = base64.b64decode(encrypted_id)
+    meta = kms.decrypt(CiphertextBlob=binary_data)
+    plaintext = meta[u'Plaintext']
+    return plaintext.decode()
+
+
+def get_secret(name):
+    """
+    Gives the decrypted value of an encrypted environment variable, from the cache when possible.
+    On a miss all the known secrets are decrypted together.
+    :param name: name of the environment variable
+    :return: decrypted value
+    """
+    names = set(SECRET_ENV_NAMES)
+    names.add(name)
+    return get_secrets(names)[name]
+
+
+def get_secrets(names=SECRET_ENV_NAMES):
+    """
+    Gives the decrypted values of encrypted environment variables.
+    The values missing from the cache are decrypted concurrently and kept for secret_cache_ttl seconds.
+    Concurrent callers missing the same values (e.g. the DB2 connect and a speculative SSH setup) wait for
+    a single round of decrypts.
+    :param names: names of the environment variables
+    :return: dict of name -> decrypted value, None when the variable is not set
+    """
+    secrets, missing = read_cache(names)
+    if missing:
+        with _decrypt_lock:
+            secrets, missing = read_cache(names)
+            if missing:
+                with tracing.span("kms_decrypt"), ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                    decrypted = dict(zip(missing, executor.map(decrypt, missing.values())))
+                expires_at = time.monotonic() + SECRET_CACHE_TTL
+                with _cache_lock:
+                    for name, value in decrypted.items():
+                        _secret_cache[name] = (missing[name], value, expires_at)
+                secrets.update(decrypted)
+    return secrets
+
+
+def read_cache(names):
+    """
+    :param names: names of the environment variables
+    :return: dict of name -> cached value (None when the variable is not set) and
+        dict of name -> encrypted value for the ones to decrypt
+    """
+    now = time.monotonic()
+    secrets = {}
+    missing = {}
+    with _cache_lock:
+        for name in names:
+            encrypted_value = os.environ.get(name)
+            cached = _secret_cache.get(name)
+            if encrypted_value is None:
+                secrets[name] = None
+            elif cached is not None and cached[0] == encrypted_value and cached[2] > now:
+                secrets[name] = cached[1]
+            else:
+                missing[name] = encrypted_value
+    return secrets, missing
+
+
+def invalidate(names=None):
+    """
+    Drops decrypted values from the cache, e.g. after an authentication failure
+    :param names: names of the environment variables, all of them when None
+    """
+    with _cache_lock:
+        if names is None:
+            _secret_cache.clear()
+        else:
+            for name in names:
+                _secret_cache.pop(name, None)
@@ -1,229 +1,607 @@
-import boto3
-from boto3 import client
-import logging
-import json
-import os
-
-import batch_execute
-import dao
-import connections
-
-
-root = logging.getLogger()
-if root.handlers:
-    for handler in root.handlers:
-        root.removeHandler(handler)
-
-logLevel = os.getenv("logLevel", "INFO").upper()
-logging.basicConfig(
-    level=(logging.INFO if logLevel == "INFO" else logging.ERROR),
-    datefmt="%H:%M:%S",
-    format="%(levelname)s: %(module)s:%(funcName)s:%(lineno)d: %(asctime)s: %(message)s",
-)
-LOG = logging.getLogger(__name__)
-
-STAGE = os.getenv("stage", "PROD").upper()
-driveIT_Update_lambda = os.getenv("driveIT_update_lambda")
-TBM_factory_feed_lambda = os.getenv("TBM_factory_feed_lambda")
-VP4R_factory_feed_lambda = os.getenv("VP4R_factory_feed_lambda")
-USE_CASE = "KB0014169 : CA_TO_US"
-SUCCESS = "Success"
-FAILED = "Failed"
-# CLOSE_NOTES = "close_notes"
-WORK_NOTES = "work_notes"
-# INCIDENT_ROUTE = "incidentRoute"
-INCIDENT_UPDATE = "incidentUpdate"
-# NO_FILE_FOUND = "No file found"
-VIN = "vin"
-INCIDENT = "incident"
-CHECK_FF_FIRST = "check_ff_first"
-
-
-def main(event, context):
-    """
-    :param event :event with Vin and incident number
-    :param context :
-    :return Output if the vehicle is TBM/VP4R and dataitem that contains Vin,incidentnumber and check_ff_first
-    """
-    LOG.info(event)
-    vin = None
-    incident_number = None
-    status = None
-    message = None
-    vehicle_type = None
-    check_ff_first = False
-
-    if type(event) == str:
-        event_obj = json.loads(event)
-    else:
-        event_obj = event
-
-    if VIN in event_obj and INCIDENT in event_obj:
-        vin = event_obj[VIN]
-        incident_number = event_obj[INCIDENT]
-        vin = vin.strip()
-        execution_flag = True
-    else:
-        execution_flag = False
-        LOG.info("VIN or Incident id not provided")
-
-    if execution_flag and vin:
-        execution_result, response_code = ca_to_us_conversion(vin)
-        if response_code == SUCCESS:
-            vehicle_type = execution_result
-            result = {
-                "vin": vin,
-                "incident": incident_number,
-                "vehicle_type": vehicle_type,
-                "check_ff_first": check_ff_first
-            }
-            LOG.info(result)
-            status = SUCCESS
-            if result["vehicle_type"] == "TBM":
-                invoke_tbm_factory_feed_lambda(json.dumps(result))
-            elif result["vehicle_type"] == "VP4R":
-                invoke_vp4r_factory_feed_lambda(json.dumps(result))
-
-
-        elif response_code == FAILED:
-            update_work_notes = {WORK_NOTES: execution_result}
-            LOG.info(update_work_notes)
-            message = update_work_notes
-            status = FAILED
-
-    else:
-        update_work_notes = {
-            WORK_NOTES: "Required data not passed or does not meet the criteria to execute Factory Feed" + str(
-                event_obj)}
-        LOG.info(update_work_notes)
-        status = FAILED
-        message = update_work_notes
-
-    if status == FAILED:
-        result = {"vin": vin, "status": status, "message": message}
-
-        LOG.info(f"Result is {json.dumps(result)}")
-
-        body = {"result": result}
-
-        incident_status = INCIDENT_UPDATE
-        response = {
-            "eventType": incident_status,
-            "incident": incident_number,
-            "body": json.dumps(body),
-        }
-
-        LOG.info(response)
-        invoke_lambda(json.dumps(response))
-        return response
-
-
-def ca_to_us_conversion(vin):
-    final_result = None
-    response_code = None
-    error = None
-    LOG.info(f"Stage: {STAGE}")
-    try:
-        LOG.info("Connecting to DB2...")
-        db_connection = connections.database_connection("CVP_" + STAGE)
-        vin_in_vehicle, is_tbm, is_vp4r = dao.check_vehicle_table(db_connection, vin)
-        if vin_in_vehicle:
-            if not(is_tbm or is_vp4r):
-                LOG.info("This VIN " + vin + " is neither a TBM nor VP4R.Therefore batch execution will fail.")
-                final_result = (f"The VIN {vin} is neither a TBM nor VP4R.Therefore batch execution will fail")
-                response_code = FAILED
-            else :
-                before_check = dao.check_vehicle_table_for_conversion(db_connection, vin)
-                if before_check:
-                    LOG.info("The VIN " + vin + "is already US. Therefore batch execution will not happen.")
-                    final_result = (f"The VIN {vin} is already US. Therefore batch execution will not happen.")
-                    response_code = FAILED
-                else:
-                 try:
-                     batch_execution, execution_error = batch_execute.execute_batch(vin)
-                     if batch_execution:
-                         vin_conversion_check = dao.check_vehicle_table_for_conversion(db_connection, vin)
-                         if vin_conversion_check:
-                             if is_tbm:
-                                 LOG.info("This VIN " + vin + " is a TBM vin ")
-                                 final_result = "TBM"
-                                 response_code = SUCCESS
-                             elif is_vp4r:
-                                 LOG.info("This VIN " + vin + " is a VP4R vin ")
-                                 final_result = "VP4R"
-                                 response_code = SUCCESS
-                         else:
-                             LOG.info(f"conversion for VIN {vin} is incomplete even after batch execution ")
-                             final_result = (f"conversion for VIN {vin} is incomplete even after batch execution ")
-                             response_code = FAILED
-                     else:
-                         LOG.error(execution_error)
-                         final_result = str(execution_error)
-                         response_code = FAILED
-                 except Exception as e:
-                     LOG.error(f"Error Occurred {str(e)}")
-                     final_result = str(e)
-                     response_code = FAILED
-                 finally:
-                     LOG.info("Closing Connection")
-                     connections.close_connection(db_connection)
-                     LOG.info("Connection Closed")
-                     LOG.info(f"Final result : {final_result}")
-                     return final_result, response_code
-        else:
-            LOG.info("The vin " + vin + " is not found in the vehicle table. please check the vin again.")
-            final_result = (f"The VIN {vin} is not found in the vehicle table. please check the vin again.")
-            response_code = FAILED
-    except Exception as e:
-        LOG.error(e)
-        final_result = str(e)
-        response_code = FAILED
-    finally:
-        LOG.info(final_result)
-        return final_result, response_code
-
-        
-def invoke_lambda(data_item):
-    """
-    Invokes driveIT wrapper lambda for updating the incident
-    :param data_item: payload for invoking lambda
-    :return:
-    """
-    lambda_client = client("lambda", region_name="us-east-1")
-    LOG.info(f"Invoking Lambda {driveIT_Update_lambda}")
-    lambda_client.invoke(
-        FunctionName=driveIT_Update_lambda,
-        InvocationType="Event",
-        Payload=json.dumps(data_item),
-    )
-
-
-def invoke_vp4r_factory_feed_lambda(data_item):
-    """
-    Invokes vp4r lambda to complete factory feed of a vp4r vehicle
-    :param data_item: payload for invoking lambda
-    :return:
-    """
-    lambda_client = client("lambda" , region_name= "us-east-1")
-    LOG.info(f"Invoking Lambda{VP4R_factory_feed_lambda}")
-    lambda_client.invoke(
-        FunctionName=VP4R_factory_feed_lambda,
-        InvocationType="Event",
-        Payload=json.dumps(data_item),
-    )
-
-
-def invoke_tbm_factory_feed_lambda(data_item):
-    """
-    Invokes tbm lambda to complete factory feed of a tbm vehicle
-    :param data_item: payload for invoking lambda
-    :return:
-    """
-    lambda_client = client("lambda" , region_name= "us-east-1")
-    LOG.info(f"Invoking Lambda{TBM_factory_feed_lambda}")
-    lambda_client.invoke(
-        FunctionName=TBM_factory_feed_lambda,
-        InvocationType="Event",
-        Payload=json.dumps(data_item),
-    )
- 
+import importlib
+import logging
+import json
+import os
+import time
+from collections import Counter
+
+import batch_execute
+import batch_scheduler
+import connections
+import dispatcher
+import idempotency
+import log_setup
+import outcomes
+import planner
+import tracing
+
+LOG = logging.getLogger(__name__)
+log_setup.configure()
+
+STAGE = os.getenv("stage", "PROD").upper()
+driveIT_Update_lambda = os.getenv("driveIT_update_lambda")
+TBM_factory_feed_lambda = os.getenv("TBM_factory_feed_lambda")
+VP4R_factory_feed_lambda = os.getenv("VP4R_factory_feed_lambda")
+USE_CASE = "KB0014169 : CA_TO_US"
+SUCCESS = "Success"
+FAILED = "Failed"
+DUPLICATE = "Duplicate"
+FEED_PENDING = "Feed pending"
+# CLOSE_NOTES = "close_notes"
+WORK_NOTES = "work_notes"
+# INCIDENT_ROUTE = "incidentRoute"
+INCIDENT_UPDATE = "incidentUpdate"
+# NO_FILE_FOUND = "No file found"
+VIN = "vin"
+INCIDENT = "incident"
+CHECK_FF_FIRST = "check_ff_first"
+ITEMS = "items"
+PLAN = "plan"
+RECORDS = "Records"
+FUNCTION_NAME = os.getenv("AWS_LAMBDA_FUNCTION_NAME", "ca_to_us")
+EAGER_INIT = os.getenv("eager_init", "false").lower() == "true"
+SQS_MAX_RECEIVE_COUNT = int(os.getenv("sqs_max_receive_count", 0))
+HEAVY_MODULES = ("boto3", "ibm_db", "paramiko")
+
+
+def main(event, context):
+    """
+    :param event :event with Vin and incident number, a list of them (or {"items": [...]}) for a multi-VIN batch,
+        an SQS event whose Records bodies hold them, or {"plan": [vins]} to only plan the conversion
+    :param context :
+    :return Output if the vehicle is TBM/VP4R and dataitem that contains Vin,incidentnumber and check_ff_first
+    """
+    tracing.start_invocation(FUNCTION_NAME, context)
+    connections.set_deadline(context)
+    log_setup.bind(request_id=getattr(context, "aws_request_id", None))
+    try:
+        return handle_event(event, context)
+    finally:
+        tracing.finish_invocation()
+        log_setup.clear()
+        log_setup.flush()
+
+
+def handle_event(event, context):
+    """
+    Processes a single-VIN or multi-VIN event
+    :param event :event with Vin and incident number, a list of them (or {"items": [...]}) for a multi-VIN batch,
+        an SQS event whose Records bodies hold them, or {"plan": [vins]} to only plan the conversion
+    :param context :
+    :return Output if the vehicle is TBM/VP4R and dataitem that contains Vin,incidentnumber and check_ff_first
+    """
+    LOG.info("Event : %.1000s", event)
+    vin = None
+    incident_number = None
+    status = None
+    message = None
+    vehicle_type = None
+    check_ff_first = False
+
+    if type(event) == str:
+        event_obj = json.loads(event)
+    else:
+        event_obj = event
+
+    if isinstance(event_obj, list):
+        return process_batch_event(event_obj, context)
+    if isinstance(event_obj, dict):
+        if ITEMS in event_obj:
+            return process_batch_event(event_obj[ITEMS], context)
+        if RECORDS in event_obj:
+            return process_sqs_event(event_obj[RECORDS], context)
+        if PLAN in event_obj:
+            return plan_vins(event_obj[PLAN])
+
+    if VIN in event_obj and INCIDENT in event_obj:
+        vin = event_obj[VIN]
+        incident_number = event_obj[INCIDENT]
+        vin = vin.strip()
+        execution_flag = True
+        log_setup.bind(vin=vin, incident=incident_number)
+    else:
+        execution_flag = False
+        LOG.info("VIN or Incident id not provided")
+
+    if execution_flag and vin:
+        previous = idempotency.claim(vin, incident_number)
+        if previous is not None and not is_feed_pending(previous):
+            return duplicate_result(vin, incident_number, previous)
+        outcome = outcomes.BatchOutcome([vin])
+        history = {}
+        try:
+            if previous is not None:
+                LOG.info("VIN %s already converted, sending its factory feed again", vin)
+                execution_result, response_code = previous["outcome"]["vehicle_type"], SUCCESS
+                outcome.add_feed_retry(vin, execution_result)
+            else:
+                execution_result, response_code = ca_to_us_conversion(vin, context, outcome)
+            history[vin] = (execution_result, response_code)
+            if response_code == SUCCESS:
+                vehicle_type = execution_result
+                status = FEED_PENDING
+                dispatch_factory_feed(vin, incident_number, vehicle_type, check_ff_first)
+                status = SUCCESS
+
+            elif response_code == FAILED:
+                update_work_notes = {WORK_NOTES: execution_result}
+                LOG.info("Work notes : %s", update_work_notes)
+                message = update_work_notes
+                status = FAILED
+        finally:
+            record_outcome(vin, incident_number, status, vehicle_type)
+            if status == FEED_PENDING:
+                history[vin] = ("Factory feed not sent", FAILED)
+                outcome.categories[vin] = outcomes.FEED_NOT_SENT
+            if history:
+                outcomes.record(outcome, history)
+
+    else:
+        update_work_notes = {
+            WORK_NOTES: "Required data not passed or does not meet the criteria to execute Factory Feed" + str(
+                event_obj)}
+        LOG.info("Work notes : %s", update_work_notes)
+        status = FAILED
+        message = update_work_notes
+
+    if status == FAILED:
+        return send_incident_update(vin, incident_number, message)
+
+
+def process_batch_event(items, context=None):
+    """
+    Converts all the VINs of a multi-VIN event with a single remote batch run
+    :param items: list of dicts with vin and incident
+    :param context: lambda context
+    :return dict with the per-VIN result of the conversion, in the order of the items
+    """
+    results = convert_items(items, context)
+    LOG.info("Batch results : %s", Counter(result["status"] for result in results))
+    return {"results": results}
+
+
+def plan_vins(vins):
+    """
+    Tells what the conversion would do with the VINs, without converting them
+    :param vins: list of vins
+    :return dict with the VINs to convert per vehicle type, the already US, not found and unsupported ones,
+        the work notes of the VINs not converted and the count of each partition
+    """
+    assert isinstance(vins, list), "Please provide a list of VINs to plan"
+
+    db_connection = connections.get_database_connection("CVP_" + STAGE)
+    try:
+        with tracing.span("vehicle_classification"):
+            plan = planner.plan_conversion(db_connection, [vin.strip() for vin in vins if isinstance(vin, str)])
+    finally:
+        connections.release_database_connection(db_connection)
+    return plan.to_dict()
+
+
+def process_sqs_event(records, context=None):
+    """
+    Converts the VINs of an SQS batch with a single remote batch run. Each message body holds a vin and an
+    incident; messages repeating the same vin and incident are converted once.
+    Only the messages that failed for a transient reason are reported, so that SQS redelivers them and deletes
+    the rest (the event source mapping needs ReportBatchItemFailures). The incident of a transient failure is
+    updated on every failure, or when sqs_max_receive_count is set to the maxReceiveCount of the redrive policy,
+    only on the last delivery, when ApproximateReceiveCount reaches it.
+    :param records: list of SQS records
+    :param context: lambda context
+    :return dict with the batchItemFailures of the partial batch response
+    """
+    message_ids = {}
+    receive_counts = {}
+    items = []
+    for record in records:
+        try:
+            item = json.loads(record["body"])
+        except (TypeError, ValueError) as e:
+            LOG.error("Message %s has no valid JSON body : %s", record.get('messageId'), e)
+            item = record.get("body")
+        if isinstance(item, dict) and isinstance(item.get(VIN), str):
+            key = (item[VIN].strip(), item.get(INCIDENT))
+        else:
+            key = (None, record["messageId"])
+        if key not in message_ids:
+            message_ids[key] = []
+            items.append(item)
+        message_ids[key].append(record["messageId"])
+        receive_count = int((record.get("attributes") or {}).get("ApproximateReceiveCount", 1))
+        receive_counts[key] = max(receive_counts.get(key, 0), receive_count)
+
+    LOG.info("%s SQS messages, %s distinct events", len(records), len(items))
+    last_attempts = [SQS_MAX_RECEIVE_COUNT <= receive_counts[key] for key in message_ids]
+    failures = []
+    for message_group, result in zip(message_ids.values(), convert_items(items, context, last_attempts)):
+        if result.get("retryable"):
+            failures.extend({"itemIdentifier": message_id} for message_id in message_group)
+    LOG.info("%s SQS messages to be retried", len(failures))
+    return {"batchItemFailures": failures}
+
+
+def convert_items(items, context=None, last_attempts=None):
+    """
+    Claims, converts and dispatches the vin + incident items with one DB2 session and one remote batch run.
+    The items whose VIN was converted by a previous event without its factory feed only get the feed sent again.
+    :param items: list of dicts with vin and incident
+    :param context: lambda context
+    :param last_attempts: list of booleans aligned with items, whether the item is not delivered again after
+        a retryable failure; None when no item is redelivered. The incident of a retryable failure is updated
+        only on the last attempt.
+    :return list of per-item results, in the order of the items; failed results are flagged retryable
+        unless retrying cannot change the outcome (invalid item, VIN not eligible)
+    """
+    check_ff_first = False
+    results = [None] * len(items)
+    valid_items = []
+    feed_retries = []
+    invocations = []
+    feeds = {}
+    feed_pending = set()
+    dispatched = False
+
+    for index, item in enumerate(items):
+        if isinstance(item, dict) and isinstance(item.get(VIN), str) and INCIDENT in item and item[VIN].strip():
+            vin, incident_number = item[VIN].strip(), item[INCIDENT]
+            previous = idempotency.claim(vin, incident_number)
+            if previous is not None and is_feed_pending(previous):
+                feed_retries.append((index, vin, incident_number, previous["outcome"]["vehicle_type"]))
+            elif previous is not None:
+                results[index] = duplicate_result(vin, incident_number, previous)
+                results[index]["retryable"] = previous["status"] != idempotency.COMPLETED
+            else:
+                valid_items.append((index, vin, incident_number))
+        else:
+            update_work_notes = {
+                WORK_NOTES: "Required data not passed or does not meet the criteria to execute Factory Feed" + str(
+                    item)}
+            LOG.info("Work notes : %s", update_work_notes)
+            incident_number = item.get(INCIDENT) if isinstance(item, dict) else None
+            invocations.append(incident_update_invocation(None, incident_number, update_work_notes))
+            results[index] = {"vin": None, "incident": incident_number, "status": FAILED,
+                              "message": update_work_notes, "retryable": False}
+
+    converted = {}
+    vins = list(dict.fromkeys(vin for _, vin, _ in valid_items))
+    outcome = outcomes.BatchOutcome(list(vins))
+    history = {}
+    try:
+        rejected = set()
+        conversions = ca_to_us_conversion_batch(vins, context, rejected, outcome) if vins else {}
+        history.update(conversions)
+
+        for index, vin, incident_number in valid_items:
+            execution_result, response_code = conversions[vin]
+            if response_code == SUCCESS:
+                invocation = factory_feed_invocation(vin, incident_number, execution_result, check_ff_first)
+                if invocation is not None:
+                    feeds[len(invocations)] = index
+                    invocations.append(invocation)
+                converted[(vin, incident_number)] = execution_result
+                results[index] = {"vin": vin, "incident": incident_number, "status": SUCCESS,
+                                  "vehicle_type": execution_result}
+            else:
+                update_work_notes = {WORK_NOTES: execution_result}
+                retryable = vin not in rejected
+                if not retryable or last_attempts is None or last_attempts[index]:
+                    invocations.append(incident_update_invocation(vin, incident_number, update_work_notes))
+                else:
+                    LOG.info("Incident %s not updated, the event is delivered again", incident_number,
+                             extra=log_setup.per_vin(vin, incident=incident_number))
+                results[index] = {"vin": vin, "incident": incident_number, "status": FAILED,
+                                  "message": update_work_notes, "retryable": retryable}
+
+        for index, vin, incident_number, vehicle_type in feed_retries:
+            LOG.info("VIN %s already converted, sending its factory feed again", vin,
+                     extra=log_setup.per_vin(vin, incident=incident_number))
+            feeds[len(invocations)] = index
+            invocations.append(factory_feed_invocation(vin, incident_number, vehicle_type, check_ff_first))
+            converted[(vin, incident_number)] = vehicle_type
+            outcome.add_feed_retry(vin, vehicle_type)
+            history[vin] = (vehicle_type, SUCCESS)
+            results[index] = {"vin": vin, "incident": incident_number, "status": SUCCESS,
+                              "vehicle_type": vehicle_type}
+
+        updates = []
+        for position, error in enumerate(dispatcher.dispatch(invocations)):
+            if error is not None and position in feeds:
+                index = feeds[position]
+                result = results[index]
+                feed_pending.add((result["vin"], result["incident"]))
+                update_work_notes = {WORK_NOTES: f"Factory feed not sent : {str(error)}"}
+                history[result["vin"]] = (update_work_notes[WORK_NOTES], FAILED)
+                outcome.categories[result["vin"]] = outcomes.FEED_NOT_SENT
+                if last_attempts is None or last_attempts[index]:
+                    updates.append(incident_update_invocation(result["vin"], result["incident"], update_work_notes))
+                results[index] = {"vin": result["vin"], "incident": result["incident"], "status": FAILED,
+                                  "message": update_work_notes, "retryable": True}
+        dispatched = True
+        if updates:
+            dispatcher.dispatch(updates)
+    finally:
+        if not dispatched:
+            feed_pending.update((results[index]["vin"], results[index]["incident"]) for index in feeds.values())
+        for _, vin, incident_number in valid_items + [retry[:3] for retry in feed_retries]:
+            vehicle_type = converted.get((vin, incident_number))
+            if vehicle_type is None:
+                record_outcome(vin, incident_number, FAILED)
+            else:
+                record_outcome(vin, incident_number,
+                               FEED_PENDING if (vin, incident_number) in feed_pending else SUCCESS, vehicle_type)
+        if history:
+            outcomes.record(outcome, history)
+
+    return results
+
+
+def record_outcome(vin, incident_number, status, vehicle_type=None):
+    """
+    Keeps the outcome of a converted VIN for the duplicate events, forgets a failed one so that it can be retried.
+    A VIN converted without its factory feed is kept as Feed pending, the next event only sends the feed again
+    since the VIN is already US.
+    :param vin: string, processed vin
+    :param incident_number: string, incident of the vin
+    :param status: Success, Feed pending or Failed
+    :param vehicle_type: string, TBM or VP4R for a converted vin
+    """
+    if status in (SUCCESS, FEED_PENDING):
+        idempotency.complete(vin, incident_number, {"status": status, "vehicle_type": vehicle_type})
+    else:
+        idempotency.release(vin, incident_number)
+
+
+def is_feed_pending(previous):
+    """
+    :param previous: dict, idempotency record of a previous event
+    :return boolean, whether the previous event converted the VIN without sending its factory feed
+    """
+    outcome = previous["outcome"] or {}
+    return previous["status"] == idempotency.COMPLETED and outcome.get("status") == FEED_PENDING
+
+
+def duplicate_result(vin, incident_number, previous):
+    """
+    Result of an event already in progress or completed, nothing is sent downstream
+    :param vin: string, vin of the event
+    :param incident_number: string, incident of the event
+    :param previous: dict, idempotency record of the previous event
+    :return dict
+    """
+    return {"vin": vin, "incident": incident_number, "status": DUPLICATE,
+            "previous_status": previous["status"], "outcome": previous["outcome"]}
+
+
+def dispatch_factory_feed(vin, incident_number, vehicle_type, check_ff_first=False):
+    """
+    Invokes the factory feed lambda matching the vehicle type of a converted VIN
+    :param vin: string, converted vin
+    :param incident_number: string, incident of the vin
+    :param vehicle_type: string, TBM or VP4R
+    :param check_ff_first: boolean
+    :return:
+    """
+    result = {
+        "vin": vin,
+        "incident": incident_number,
+        "vehicle_type": vehicle_type,
+        "check_ff_first": check_ff_first
+    }
+    LOG.info("Factory feed : %s", result, extra=log_setup.per_vin(vin, incident=incident_number))
+    if result["vehicle_type"] == "TBM":
+        invoke_tbm_factory_feed_lambda(result)
+    elif result["vehicle_type"] == "VP4R":
+        invoke_vp4r_factory_feed_lambda(result)
+
+
+def factory_feed_invocation(vin, incident_number, vehicle_type, check_ff_first=False):
+    """
+    Builds the invocation of the factory feed lambda matching the vehicle type of a converted VIN
+    :param vin: string, converted vin
+    :param incident_number: string, incident of the vin
+    :param vehicle_type: string, TBM or VP4R
+    :param check_ff_first: boolean
+    :return (function name, payload), None when the vehicle type has no factory feed
+    """
+    if vehicle_type == "TBM":
+        function_name = TBM_factory_feed_lambda
+    elif vehicle_type == "VP4R":
+        function_name = VP4R_factory_feed_lambda
+    else:
+        return None
+    return function_name, {"vin": vin, "incident": incident_number, "vehicle_type": vehicle_type,
+                           "check_ff_first": check_ff_first}
+
+
+def send_incident_update(vin, incident_number, message):
+    """
+    Sends the failure of a VIN to the driveIT update lambda
+    :param vin: string, vin which failed
+    :param incident_number: string, incident to be updated
+    :param message: dict, work notes for the incident
+    :return response sent to the driveIT update lambda
+    """
+    _, response = incident_update_invocation(vin, incident_number, message)
+    invoke_lambda(response)
+    return response
+
+
+def incident_update_invocation(vin, incident_number, message):
+    """
+    Builds the invocation of the driveIT update lambda for the failure of a VIN
+    :param vin: string, vin which failed
+    :param incident_number: string, incident to be updated
+    :param message: dict, work notes for the incident
+    :return (function name, payload)
+    """
+    result = {"vin": vin, "status": FAILED, "message": message}
+
+
+    body = {"result": result}
+
+    incident_status = INCIDENT_UPDATE
+    response = {
+        "eventType": incident_status,
+        "incident": incident_number,
+        "body": json.dumps(body),
+    }
+
+    LOG.info("Incident update : %s", response, extra=log_setup.per_vin(vin, incident=incident_number))
+    return driveIT_Update_lambda, response
+
+
+def ca_to_us_conversion(vin, context=None, outcome=None):
+    """
+    Converts a single VIN from CA to US
+    :param vin: string, vin to be processed
+    :param context: lambda context
+    :param outcome: optional outcomes.BatchOutcome, as in ca_to_us_conversion_batch
+    :return final_result: TBM/VP4R on success, reason of the failure otherwise
+    :return response_code: Success or Failed
+    """
+    final_result, response_code = ca_to_us_conversion_batch([vin], context, outcome=outcome)[vin]
+    LOG.info("Final result : %s", final_result)
+    return final_result, response_code
+
+
+def ca_to_us_conversion_batch(vins, context=None, rejected=None, outcome=None):
+    """
+    Converts the VINs from CA to US with one DB2 connection and one remote batch run.
+    With speculative_setup=true the SSH session is set up in the background while VEHICLE table is checked.
+    The outcome of every VIN is appended to the outcome history when one is enabled (see outcomes.py).
+    :param vins: list of vins to be processed
+    :param context: lambda context, bounds the wait for the conversion
+    :param rejected: optional set, receives the vins failed by the eligibility check
+    :param outcome: optional outcomes.BatchOutcome filled by the conversion and recorded by the caller once the
+        factory feeds are sent, by default the outcome is recorded at the end of the conversion
+    :return dict of vin -> (final_result, response_code)
+    """
+    results = {}
+    eligible = {}
+    db_connection = None
+    own_outcome = outcome is None
+    if own_outcome:
+        outcome = outcomes.BatchOutcome(vins)
+    ssh_setup = connections.start_ssh_setup(batch_execute.STAGE) if connections.SPECULATIVE_SETUP else None
+    LOG.info("Stage: %s", STAGE)
+    try:
+        LOG.info("Connecting to DB2...")
+        db_connection = connections.get_database_connection("CVP_" + STAGE)
+        with tracing.span("vehicle_classification"):
+            plan = planner.plan_conversion(db_connection, vins)
+        eligible = plan.eligible
+        outcome.add_plan(plan)
+        for vin, work_notes in plan.work_notes.items():
+            results[vin] = (work_notes[planner.WORK_NOTES], FAILED)
+            if rejected is not None:
+                rejected.add(vin)
+
+        if eligible:
+            started_at = time.monotonic()
+            executions = batch_scheduler.execute_batch(list(eligible))
+            outcome.batch_size = len(eligible)
+            executed = {vin: vehicle_type for vin, vehicle_type in eligible.items() if executions[vin][0]}
+            for vin in eligible.keys() - executed.keys():
+                execution_error = executions[vin][1]
+                LOG.error("Batch execution failed : %s", execution_error, extra=log_setup.per_vin(vin))
+                results[vin] = (str(execution_error), FAILED)
+                outcome.categories[vin] = outcomes.BATCH_FAILED
+            if executed:
+                results.update(verify_conversion(db_connection, executed, context, started_at, outcome))
+    except Exception as e:
+        LOG.error("Error Occurred : %s", e)
+        for vin in vins:
+            results.setdefault(vin, (str(e), FAILED))
+    finally:
+        if not eligible:
+            connections.cancel_ssh_setup(ssh_setup)
+        if db_connection is not None:
+            LOG.info("Releasing Connection")
+            connections.release_database_connection(db_connection)
+            LOG.info("Connection Released")
+    if own_outcome:
+        outcomes.record(outcome, results)
+    LOG.info("Final result : %s", Counter(response_code for _, response_code in results.values()))
+    return results
+
+
+def verify_conversion(db_connection, eligible, context=None, started_at=None, outcome=None):
+    """
+    Checks the destination country of the VINs after the batch execution, polling until they are US
+    unless the batch waits a fixed time
+    :param db_connection: ibm_db connect object
+    :param eligible: dict of vin -> vehicle type (TBM or VP4R) processed by the batch
+    :param context: lambda context, bounds the polling
+    :param started_at: float, time.monotonic() when the batch started
+    :param outcome: optional outcomes.BatchOutcome, receives the time-to-convert and the polling attempts
+    :return dict of vin -> (final_result, response_code)
+    """
+    results = {}
+    deadline = None if batch_execute.WAIT_MODE == batch_execute.SLEEP else batch_execute.get_deadline(context)
+    try:
+        converted, attempts = batch_execute.wait_for_conversion(db_connection, eligible, deadline, started_at)
+    except Exception as e:
+        LOG.error("Error Occurred %s", e)
+        return {vin: (str(e), FAILED) for vin in eligible}
+    if outcome is not None:
+        outcome.conversion_times.update(converted)
+        outcome.poll_attempts = attempts
+
+    for vin, vehicle_type in eligible.items():
+        if vin in converted:
+            LOG.info("This VIN %s is a %s vin ", vin, vehicle_type, extra=log_setup.per_vin(vin))
+            results[vin] = (vehicle_type, SUCCESS)
+        else:
+            LOG.info("conversion for VIN %s is incomplete even after batch execution ", vin,
+                     extra=log_setup.per_vin(vin))
+            results[vin] = (f"conversion for VIN {vin} is incomplete even after batch execution ", FAILED)
+            if outcome is not None:
+                outcome.categories[vin] = outcomes.INCOMPLETE
+    return results
+
+
+def warm_up():
+    """
+    Imports the heavy libraries and parses the configuration ahead of the first event,
+    for containers initialized before traffic (eager_init=true)
+    """
+    import config
+
+    for module_name in HEAVY_MODULES:
+        importlib.import_module(module_name)
+    config.get_config()
+    dispatcher.get_client()
+
+
+def invoke_lambda(data_item):
+    """
+    Invokes driveIT wrapper lambda for updating the incident
+    :param data_item: payload for invoking lambda
+    :return:
+    """
+    LOG.info("Invoking Lambda %s", driveIT_Update_lambda)
+    dispatcher.invoke(driveIT_Update_lambda, data_item)
+
+
+def invoke_vp4r_factory_feed_lambda(data_item):
+    """
+    Invokes vp4r lambda to complete factory feed of a vp4r vehicle
+    :param data_item: payload for invoking lambda
+    :return:
+    """
+    LOG.info("Invoking Lambda %s", VP4R_factory_feed_lambda)
+    dispatcher.invoke(VP4R_factory_feed_lambda, data_item)
+
+
+def invoke_tbm_factory_feed_lambda(data_item):
+    """
+    Invokes tbm lambda to complete factory feed of a tbm vehicle
+    :param data_item: payload for invoking lambda
+    :return:
+    """
+    LOG.info("Invoking Lambda %s", TBM_factory_feed_lambda)
+    dispatcher.invoke(TBM_factory_feed_lambda, data_item)
+
+
+if EAGER_INIT:
+    warm_up()
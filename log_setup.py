@@ -0,0 +1,191 @@
+"""Logging setup shared by all the modules, configured once by the entry points (lambda_handler, bulk_convert,
+outcomes and the benchmarks) with configure().
+
+Records are put on a bounded queue by the calling thread and written by a listener thread, so that logging
+never waits for the output. The listener writes one JSON object per line with the context bound for the
+event (VIN, incident, request id) and the fields passed with extra. Per-VIN messages are marked with
+extra=per_vin(vin) and sampled according to log_sample_rates, e.g. "INFO=0.01,WARNING=0.5".
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+logLevel = (os.getenv("logLevel", "INFO")).upper()
+LOG_FORMAT = os.getenv("log_format", "json").lower()
+LOG_QUEUE_SIZE = int(os.getenv("log_queue_size", 10000))
+LOG_SAMPLE_RATES = os.getenv("log_sample_rates", "")
+LOG_FLUSH_TIMEOUT = float(os.getenv("log_flush_timeout", 2))
+TEXT_FORMAT = "%(levelname)s: %(module)s:%(funcName)s:%(lineno)d: %(asctime)s: %(message)s"
+SAMPLED = "sampled"
+CONTEXT_FIELDS = ("vin", "incident", "request_id")
+RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_context = contextvars.ContextVar("log_context", default={})
+_lock = threading.Lock()
+_listener = None
+log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+stats = {"dropped": 0, "sampled_out": 0}
+
+
+def parse_sample_rates(value):
+    """
+    :param value: string, comma-separated LEVEL=rate pairs
+    :return dict of level number -> fraction of the per-VIN records kept
+    """
+    rates = {}
+    for pair in value.split(","):
+        if "=" in pair:
+            level, rate = pair.split("=", 1)
+            rates[logging.getLevelName(level.strip().upper())] = float(rate)
+    return rates
+
+
+SAMPLE_RATES = parse_sample_rates(LOG_SAMPLE_RATES)
+
+
+class ContextFilter(logging.Filter):
+    """Adds the bound context to the records and samples the per-VIN ones"""
+
+    def filter(self, record):
+        if getattr(record, SAMPLED, False):
+            rate = SAMPLE_RATES.get(record.levelno, 1.0)
+            if rate < 1.0 and random.random() >= rate:
+                stats["sampled_out"] += 1
+                return False
+        for name, value in _context.get().items():
+            if not hasattr(record, name):
+                setattr(record, name, value)
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler dropping the records when the queue is full instead of waiting for the listener"""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            stats["dropped"] += 1
+
+    def prepare(self, record):
+        """Merges the args into the message, the JSON encoding is left to the listener thread"""
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the context and extra fields"""
+
+    def format(self, record):
+        document = {
+            "timestamp": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "function": record.funcName,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in RECORD_FIELDS and name != SAMPLED:
+                document[name] = value
+        if record.exc_text:
+            document["exception"] = record.exc_text
+        return json.dumps(document, default=str)
+
+
+def level():
+    """
+    :return logging level of logLevel, INFO or ERROR
+    """
+    return logging.INFO if logLevel == "INFO" else logging.ERROR
+
+
+def configure():
+    """
+    Replaces the handlers of the root logger (including the one installed by the lambda runtime) with the queue
+    handler and starts the listener thread. Called by the entry points, the next calls do nothing.
+    """
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        output = logging.StreamHandler(sys.stderr)
+        output.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT, "%H:%M:%S"))
+        handler = NonBlockingQueueHandler(log_queue)
+        handler.addFilter(ContextFilter())
+        root.addHandler(handler)
+        root.setLevel(level())
+        _listener = logging.handlers.QueueListener(log_queue, output)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+def bind(**fields):
+    """
+    Sets context fields added to every record of the current event, e.g. bind(vin=vin, incident=incident)
+    :param fields: field name -> value, None removes the field
+    """
+    context = dict(_context.get())
+    for name, value in fields.items():
+        if value is None:
+            context.pop(name, None)
+        else:
+            context[name] = value
+    _context.set(context)
+
+
+def clear():
+    """Removes all the context fields"""
+    _context.set({})
+
+
+def per_vin(vin, **fields):
+    """
+    Extra of the high-volume per-VIN messages, sampled according to log_sample_rates
+    :param vin: string
+    :param fields: other fields of the record
+    :return dict to pass as extra
+    """
+    return dict(fields, vin=vin, sampled=True)
+
+
+def flush(timeout=LOG_FLUSH_TIMEOUT):
+    """
+    Waits until the listener has written the queued records, to be called before the lambda returns
+    since the runtime may freeze the container as soon as the handler exits
+    :param timeout: float, maximum seconds to wait
+    """
+    deadline = time.monotonic() + timeout
+    while log_queue.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.001)
+    if _listener is not None:
+        for handler in _listener.handlers:
+            handler.flush()
+
+
+def shutdown():
+    """Writes the queued records and stops the listener thread"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
@@ -0,0 +1,363 @@
+"""History of the CA to US conversion outcomes and latency analytics.
+
+Every VIN converted by the lambda or by a batch_pipeline chunk (bulk_convert) is appended to the outcome
+store with its vehicle type, result, failure category, the stage timings, the remote batch duration, the
+polling attempts and the time-to-convert. A VIN converted without its factory feed is recorded as
+feed_not_sent, and again once the feed is sent. The report gives the throughput, p50/p95/p99 of the
+time-to-convert and the failure breakdowns over a time window:
+
+    python outcomes.py --since 24h --bucket 1h
+"""
+import abc
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import log_setup
+import planner
+import tracing
+
+OUTCOME_BACKEND = os.getenv("outcome_backend", "none" if os.getenv("AWS_LAMBDA_FUNCTION_NAME") else "sqlite").lower()
+OUTCOME_DB_PATH = os.getenv("outcome_db_path", "/tmp/ca_to_us_outcomes.db")
+SQLITE = "sqlite"
+NONE = "none"
+SUCCESS = "Success"
+FAILED = "Failed"
+CONVERTED = "converted"
+BATCH_FAILED = "batch_failed"
+INCOMPLETE = "incomplete"
+FEED_NOT_SENT = "feed_not_sent"
+ERROR = "error"
+FIELDS = ("recorded_at", "request_id", "vin", "vehicle_type", "result", "category", "reason", "batch_size",
+          "batch_seconds", "poll_attempts", "time_to_convert", "stages")
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+REMOTE_BATCH = "remote_batch"
+
+LOG = logging.getLogger(__name__)
+
+
+class OutcomeStore(abc.ABC):
+    """
+    History of the outcomes, appended to by the conversions and read back by report.
+    Records are dicts with the keys of FIELDS, stages being a dict of stage -> milliseconds. The lambda needs
+    a store readable from outside its containers, e.g. a Timestream table, installed with set_store.
+    """
+
+    @abc.abstractmethod
+    def append(self, records):
+        """
+        Adds records to the history
+        :param records: list of dicts
+        """
+
+    @abc.abstractmethod
+    def query(self, since=None, until=None):
+        """
+        :param since: float, epoch seconds of the oldest record, None for no bound
+        :param until: float, epoch seconds after the newest record, None for no bound
+        :return iterable of the records recorded in the window, oldest first
+        """
+
+
+class SQLiteOutcomeStore(OutcomeStore):
+    """Outcomes table in the SQLite file read by the report of this module, written by the conversions run on
+    the same host such as bulk_convert. The file of a lambda container is lost with it, which is why the
+    lambda does not use this store by default."""
+
+    def __init__(self, path=OUTCOME_DB_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS outcomes (recorded_at REAL NOT NULL, request_id TEXT, vin TEXT NOT NULL, "
+            "vehicle_type TEXT, result TEXT NOT NULL, category TEXT, reason TEXT, batch_size INTEGER, "
+            "batch_seconds REAL, poll_attempts INTEGER, time_to_convert REAL, stages TEXT)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS outcomes_recorded_at ON outcomes (recorded_at)")
+
+    def append(self, records):
+        rows = [tuple(json.dumps(record[field]) if field == "stages" else record[field] for field in FIELDS)
+                for record in records]
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany(
+                    f"INSERT INTO outcomes ({', '.join(FIELDS)}) VALUES ({', '.join('?' * len(FIELDS))})", rows)
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def query(self, since=None, until=None):
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT {', '.join(FIELDS)} FROM outcomes WHERE recorded_at >= ? AND recorded_at < ? "
+                "ORDER BY recorded_at",
+                (since if since is not None else float("-inf"), until if until is not None else float("inf")),
+            ).fetchall()
+        for row in rows:
+            record = dict(zip(FIELDS, row))
+            record["stages"] = json.loads(record["stages"]) if record["stages"] else {}
+            yield record
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    Opens the SQLite file of outcome_db_path on the first record when outcome_backend=sqlite, the default
+    outside the lambda
+    :return OutcomeStore, None when no history is kept
+    """
+    global _store
+    assert OUTCOME_BACKEND in (SQLITE, NONE), f"Unknown outcome backend {OUTCOME_BACKEND}"
+    with _store_lock:
+        if _store is None and OUTCOME_BACKEND == SQLITE:
+            _store = SQLiteOutcomeStore()
+        return _store
+
+
+def set_store(store):
+    """
+    Makes the conversions append to another history, e.g. one shared by the lambda containers
+    :param store: OutcomeStore, None to stop recording
+    """
+    global _store
+    with _store_lock:
+        _store = store
+
+
+class BatchOutcome:
+    """What happens to the VINs of one conversion batch, filled along the way and recorded at the end"""
+
+    def __init__(self, vins):
+        """
+        :param vins: list of vins of the batch
+        """
+        self.vins = vins
+        self.vehicle_types = {}
+        self.categories = {}
+        self.conversion_times = {}
+        self.batch_size = 0
+        self.poll_attempts = None
+
+    def add_plan(self, plan):
+        """
+        Takes the vehicle types and the categories of the VINs which are not converted from the plan
+        :param plan: planner.EligibilityPlan
+        """
+        for vehicle_type, vins in plan.to_convert.items():
+            for vin in vins:
+                self.vehicle_types[vin] = vehicle_type
+        for category, vins in ((planner.ALREADY_US, plan.already_us), (planner.NOT_FOUND, plan.not_found)):
+            for vin in vins:
+                self.categories[vin] = category
+        for vin, vehicle_type in plan.unsupported.items():
+            self.vehicle_types[vin] = vehicle_type
+            self.categories[vin] = planner.UNSUPPORTED
+
+    def add_feed_retry(self, vin, vehicle_type):
+        """
+        Adds a VIN converted by a previous event, whose factory feed is sent again
+        :param vin: string
+        :param vehicle_type: string, TBM or VP4R
+        """
+        self.vins.append(vin)
+        self.vehicle_types[vin] = vehicle_type
+
+    def records(self, results, request_id=None, stages=None):
+        """
+        :param results: dict of vin -> (final_result, response_code) given by the conversion
+        :param request_id: string, id of the lambda invocation
+        :param stages: dict of stage -> milliseconds spent by the invocation, the remote_batch stage gives
+            the duration of the remote batch runs
+        :return list of dicts
+        """
+        recorded_at = time.time()
+        stages = {stage: round(duration, 3) for stage, duration in (stages or {}).items()}
+        batch_seconds = stages[REMOTE_BATCH] / 1000 if REMOTE_BATCH in stages else None
+        records = []
+        for vin in dict.fromkeys(self.vins):
+            final_result, response_code = results.get(vin, (None, FAILED))
+            success = response_code == SUCCESS
+            records.append({
+                "recorded_at": recorded_at,
+                "request_id": request_id,
+                "vin": vin,
+                "vehicle_type": self.vehicle_types.get(vin),
+                "result": response_code,
+                "category": CONVERTED if success else self.categories.get(vin, ERROR),
+                "reason": None if success else final_result,
+                "batch_size": self.batch_size,
+                "batch_seconds": batch_seconds,
+                "poll_attempts": self.poll_attempts,
+                "time_to_convert": self.conversion_times.get(vin),
+                "stages": stages,
+            })
+        return records
+
+
+def record(outcome, results, stages=None):
+    """
+    Appends the outcome of a batch to the store. A failing store never fails the conversion.
+    :param outcome: BatchOutcome
+    :param results: dict of vin -> (final_result, response_code)
+    :param stages: dict of stage -> milliseconds, the stages of the current invocation by default
+    """
+    try:
+        store = get_store()
+        if store is not None:
+            request_id, invocation_stages = tracing.current_stages()
+            store.append(outcome.records(results, request_id, invocation_stages if stages is None else stages))
+    except Exception as e:
+        LOG.warning("Outcomes not recorded : %s", e)
+
+
+def summarize(records):
+    """
+    :param records: iterable of records
+    :return dict with the counts, the time-to-convert, batch duration and polling statistics
+        and the failures per category and vehicle type
+    """
+    count = 0
+    converted = 0
+    first = last = None
+    time_to_convert = tracing.Histogram(size=None)
+    per_type = {}
+    batch_seconds = tracing.Histogram(size=None)
+    poll_attempts = tracing.Histogram(size=None)
+    failures = {}
+    failures_per_type = {}
+    for entry in records:
+        count += 1
+        first = entry["recorded_at"] if first is None else first
+        last = entry["recorded_at"]
+        vehicle_type = entry["vehicle_type"] or "unknown"
+        if entry["batch_seconds"] is not None:
+            batch_seconds.add(entry["batch_seconds"])
+        if entry["poll_attempts"] is not None:
+            poll_attempts.add(entry["poll_attempts"])
+        if entry["result"] == SUCCESS:
+            converted += 1
+            if entry["time_to_convert"] is not None:
+                time_to_convert.add(entry["time_to_convert"])
+                per_type.setdefault(vehicle_type, tracing.Histogram(size=None)).add(entry["time_to_convert"])
+        else:
+            failures[entry["category"]] = failures.get(entry["category"], 0) + 1
+            failures_per_type[vehicle_type] = failures_per_type.get(vehicle_type, 0) + 1
+    return {
+        "vins": count,
+        "converted": converted,
+        "failed": count - converted,
+        "failure_rate": round((count - converted) / count, 4) if count else None,
+        "first_recorded_at": first,
+        "last_recorded_at": last,
+        "time_to_convert": time_to_convert.summary(),
+        "time_to_convert_per_type": {vehicle_type: histogram.summary() for vehicle_type, histogram in per_type.items()},
+        "batch_seconds": batch_seconds.summary(),
+        "poll_attempts": poll_attempts.summary(),
+        "failures": failures,
+        "failures_per_type": failures_per_type,
+    }
+
+
+def report(store=None, since=None, until=None, bucket=None):
+    """
+    Analytics of the outcomes recorded in a time window
+    :param store: OutcomeStore, the configured one by default
+    :param since: float, epoch seconds of the start of the window, None for the oldest record
+    :param until: float, epoch seconds of the end of the window, now by default
+    :param bucket: float, seconds per bucket of the time series, None for no series
+    :return dict with the summary of the window, its throughput and the per-bucket summaries
+    """
+    store = store or get_store()
+    assert store is not None, "Outcome history is disabled"
+
+    until = until if until is not None else time.time()
+    records = list(store.query(since, until))
+    result = summarize(records)
+    start = since if since is not None else result["first_recorded_at"]
+    window = until - start if start is not None else None
+    result["window_seconds"] = round(window, 3) if window else None
+    result["converted_per_hour"] = round(result["converted"] / window * 3600, 3) if window else None
+    if bucket:
+        buckets = {}
+        for entry in records:
+            buckets.setdefault(int((entry["recorded_at"] - (start or 0)) // bucket), []).append(entry)
+        result["buckets"] = []
+        for index, entries in sorted(buckets.items()):
+            summary = summarize(entries)
+            result["buckets"].append({
+                "start": (start or 0) + index * bucket,
+                "vins": summary["vins"],
+                "converted": summary["converted"],
+                "failed": summary["failed"],
+                "converted_per_hour": round(summary["converted"] / bucket * 3600, 3),
+                "time_to_convert_p95": summary["time_to_convert"]["p95"],
+                "failures": summary["failures"],
+            })
+    return result
+
+
+def parse_duration(value):
+    """
+    :param value: string, number of seconds or a number followed by s, m, h or d, e.g. 24h
+    :return float, seconds
+    """
+    if value[-1:].lower() in DURATION_UNITS:
+        return float(value[:-1]) * DURATION_UNITS[value[-1].lower()]
+    return float(value)
+
+
+def format_seconds(value):
+    return "-" if value is None else f"{value:.2f}s"
+
+
+def print_report(result):
+    print(f"{result['vins']} VINs, {result['converted']} converted, {result['failed']} failed "
+          f"(failure rate {result['failure_rate']}), {result['converted_per_hour']} converted/hour")
+    for name in ("time_to_convert", "batch_seconds"):
+        summary = result[name]
+        print(f"  {name:<20} p50 {format_seconds(summary['p50'])}  p95 {format_seconds(summary['p95'])}  "
+              f"p99 {format_seconds(summary['p99'])}  max {format_seconds(summary['max'])}")
+    for vehicle_type, summary in sorted(result["time_to_convert_per_type"].items()):
+        print(f"  time_to_convert {vehicle_type:<4} p50 {format_seconds(summary['p50'])}  "
+              f"p95 {format_seconds(summary['p95'])}  p99 {format_seconds(summary['p99'])}")
+    print(f"  poll attempts p50 {result['poll_attempts']['p50']}  max {result['poll_attempts']['max']}")
+    print(f"  failures per category {result['failures']}")
+    print(f"  failures per vehicle type {result['failures_per_type']}")
+    for bucket in result.get("buckets", []):
+        print(f"  {time.strftime('%Y-%m-%d %H:%M', time.localtime(bucket['start']))}  {bucket['vins']:>7} VINs  "
+              f"{bucket['converted']:>7} converted  {bucket['failed']:>6} failed  "
+              f"p95 {format_seconds(bucket['time_to_convert_p95'])}  {bucket['failures']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Throughput, latency and failures of the CA to US conversions")
+    parser.add_argument("--db", default=OUTCOME_DB_PATH, help="SQLite outcome store")
+    parser.add_argument("--since", default=None, help="start of the window back from now, e.g. 30m, 24h, 7d")
+    parser.add_argument("--until", default=None, help="end of the window back from now, now by default")
+    parser.add_argument("--bucket", default=None, help="bucket of the time series, e.g. 1h")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+    log_setup.configure()
+
+    now = time.time()
+    result = report(SQLiteOutcomeStore(args.db),
+                    since=now - parse_duration(args.since) if args.since else None,
+                    until=now - parse_duration(args.until) if args.until else now,
+                    bucket=parse_duration(args.bucket) if args.bucket else None)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+    return result
+
+
+if __name__ == "__main__":
+    main()
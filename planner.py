@@ -0,0 +1,124 @@
+import logging
+
+import dao
+import log_setup
+
+TO_CONVERT = "to_convert"
+ALREADY_US = "already_us"
+NOT_FOUND = "not_found"
+UNSUPPORTED = "unsupported"
+WORK_NOTES = "work_notes"
+
+LOG = logging.getLogger(__name__)
+
+
+class EligibilityPlan:
+    """VINs partitioned by what the CA to US conversion does with them, with the work notes of the ones
+    which are not converted"""
+
+    def __init__(self):
+        self.to_convert = {dao.TBM: [], dao.VP4R: []}
+        self.already_us = []
+        self.not_found = []
+        self.unsupported = {}
+        self.work_notes = {}
+
+    def add(self, vin, vehicle_details):
+        """
+        Puts a VIN in its partition
+        :param vin: string
+        :param vehicle_details: tuple (vehicle_type, destination_country) read from VEHICLE table, None if not found
+        :return partition of the vin
+        """
+        partition, vehicle_type, reason = classify(vin, vehicle_details)
+        if partition == TO_CONVERT:
+            self.to_convert[vehicle_type].append(vin)
+            return partition
+        if partition == NOT_FOUND:
+            self.not_found.append(vin)
+        elif partition == UNSUPPORTED:
+            self.unsupported[vin] = vehicle_details[0]
+        else:
+            self.already_us.append(vin)
+        self.work_notes[vin] = {WORK_NOTES: reason}
+        return partition
+
+    @property
+    def eligible(self):
+        """
+        :return dict of vin -> TBM or VP4R for the vins to be sent to the batch
+        """
+        return {vin: vehicle_type for vehicle_type, vins in self.to_convert.items() for vin in vins}
+
+    def summary(self):
+        """
+        :return dict, number of vins per partition
+        """
+        return {
+            "to_convert_tbm": len(self.to_convert[dao.TBM]),
+            "to_convert_vp4r": len(self.to_convert[dao.VP4R]),
+            ALREADY_US: len(self.already_us),
+            NOT_FOUND: len(self.not_found),
+            UNSUPPORTED: len(self.unsupported),
+        }
+
+    def to_dict(self):
+        """
+        :return JSON-serializable plan
+        """
+        return {
+            "to_convert_tbm": self.to_convert[dao.TBM],
+            "to_convert_vp4r": self.to_convert[dao.VP4R],
+            ALREADY_US: self.already_us,
+            NOT_FOUND: self.not_found,
+            UNSUPPORTED: self.unsupported,
+            WORK_NOTES: self.work_notes,
+            "summary": self.summary(),
+        }
+
+
+def classify(vin, vehicle_details):
+    """
+    Decides what the conversion does with a VIN
+    :param vin: string
+    :param vehicle_details: tuple (vehicle_type, destination_country) read from VEHICLE table, None if not found
+    :return partition: to_convert, already_us, not_found or unsupported
+    :return vehicle_type: TBM/VP4R, None when the type is not supported or the vin is not found
+    :return reason: string, why the vin is not converted, None for the vins to convert
+    """
+    if vehicle_details is None:
+        LOG.info("The vin %s is not found in the vehicle table. please check the vin again.", vin,
+                 extra=log_setup.per_vin(vin))
+        return NOT_FOUND, None, f"The VIN {vin} is not found in the vehicle table. please check the vin again."
+    vehicle_type = dao.classify_vehicle_type(vehicle_details[0])
+    if vehicle_type is None:
+        LOG.info("This VIN %s is neither a TBM nor VP4R.Therefore batch execution will fail.", vin,
+                 extra=log_setup.per_vin(vin))
+        return UNSUPPORTED, None, f"The VIN {vin} is neither a TBM nor VP4R.Therefore batch execution will fail"
+    if vehicle_details[1] == dao.US:
+        LOG.info("The VIN %s is already US. Therefore batch execution will not happen.", vin,
+                 extra=log_setup.per_vin(vin))
+        return ALREADY_US, vehicle_type, f"The VIN {vin} is already US. Therefore batch execution will not happen."
+    LOG.info("Vin %s found in VEHICLE table and is %s", vin, vehicle_type, extra=log_setup.per_vin(vin))
+    return TO_CONVERT, vehicle_type, None
+
+
+def plan_conversion(db_connection=None, vins=None, chunk_size=dao.BULK_CHUNK_SIZE):
+    """
+    Resolves any number of VINs with chunked VEHICLE reads and partitions them
+    :param db_connection: ibm_db connect object
+    :param vins: iterable of vins, duplicates are planned once
+    :param chunk_size: int, number of vins per query
+    :return EligibilityPlan
+    """
+    assert db_connection is not None, "Connection not established"
+    assert vins is not None, "Please provide proper VINs"
+
+    vins = list(dict.fromkeys(vins))
+    vehicle_details = {vin: (vehicle_type, country)
+                       for vin, vehicle_type, country in dao.iter_vehicle_details(db_connection, vins, chunk_size)}
+    plan = EligibilityPlan()
+    for vin in vins:
+        plan.add(vin, vehicle_details.get(vin))
+    LOG.info("Plan of %s VINs : %s", len(vins), plan.summary())
+    return plan
@@ -0,0 +1,192 @@
+"""Partial batch response of lambda_handler for SQS events, against the local stand-ins of benchmarks.
+
+Run from the repository root:
+    python -m pytest tests
+"""
+import json
+import os
+
+import pytest
+
+from benchmarks import fake_ibm_db
+from benchmarks import fake_services
+from benchmarks import run_benchmark
+
+DRIVEIT_UPDATE_LAMBDA = "driveIT-update"
+TBM_FACTORY_FEED_LAMBDA = "tbm-factory-feed"
+VP4R_FACTORY_FEED_LAMBDA = "vp4r-factory-feed"
+VEHICLES = [("V1", "CVP_TBM", "CA"), ("V2", "CVP_SXM", "CA"), ("V3", "OTHER", "CA"), ("V4", "CVP_TBM", "US")]
+
+
+class HistoryStore:
+    """Outcome store keeping the records in a list"""
+
+    def __init__(self):
+        self.records = []
+
+    def append(self, records):
+        self.records.extend(records)
+
+    def query(self, since=None, until=None):
+        return iter(self.records)
+
+
+@pytest.fixture(scope="module")
+def stand_ins():
+    args = run_benchmark.parse_args(["--kms-latency", "0", "--lambda-latency", "0", "--connect-latency", "0",
+                                     "--query-latency", "0", "--batch-latency", "0"])
+    run_benchmark.prepare_environment(args)
+    os.environ["driveIT_update_lambda"] = DRIVEIT_UPDATE_LAMBDA
+    os.environ["TBM_factory_feed_lambda"] = TBM_FACTORY_FEED_LAMBDA
+    os.environ["VP4R_factory_feed_lambda"] = VP4R_FACTORY_FEED_LAMBDA
+
+    import config
+    import connections
+    import dispatcher
+    import kms_decrypt
+
+    server = fake_services.FakeBatchServer(config.file_path)
+    config.get_config()["TEST"]["server"] = "127.0.0.1"
+    config.get_config()["TEST"]["port"] = str(server.port)
+    kms_decrypt._kms_client = fake_services.FakeKMSClient()
+    lambda_client = fake_services.FakeLambdaClient()
+    dispatcher.client = lambda *client_args, **client_kwargs: lambda_client
+    dispatcher._clients.clear()
+    yield server, lambda_client
+    for session in connections.ssh_sessions.values():
+        session.close()
+    server.close()
+
+
+@pytest.fixture
+def handler(stand_ins):
+    import dao
+    import idempotency
+    import lambda_handler
+    import outcomes
+
+    server, lambda_client = stand_ins
+    fake_ibm_db.load_vehicles(VEHICLES)
+    idempotency.set_store(idempotency.MemoryIdempotencyStore())
+    outcomes.set_store(HistoryStore())
+    dao.vehicle_type_cache.clear()
+    lambda_client.invocations.clear()
+    return lambda_handler, server, lambda_client
+
+
+@pytest.fixture
+def failing_batch(monkeypatch):
+    import batch_execute
+
+    def run_on_session(query_file, retry_reused=True):
+        raise RuntimeError("batch server down")
+
+    monkeypatch.setattr(batch_execute, "run_on_session", run_on_session)
+
+
+def sqs_event(*bodies, receive_count=1):
+    """
+    :param bodies: message bodies, dicts are encoded as JSON
+    :param receive_count: int, ApproximateReceiveCount of every message
+    :return SQS event
+    """
+    return {"Records": [{"messageId": f"m{index}",
+                         "body": json.dumps(body) if isinstance(body, dict) else body,
+                         "attributes": {"ApproximateReceiveCount": str(receive_count)}}
+                        for index, body in enumerate(bodies)]}
+
+
+def failed_message_ids(response):
+    return sorted(failure["itemIdentifier"] for failure in response["batchItemFailures"])
+
+
+def invoked(lambda_client, function_name):
+    """
+    :return list of the decoded payloads sent to the lambda
+    """
+    return [json.loads(payload) for name, payload in lambda_client.invocations if name == function_name]
+
+
+def test_repeated_messages_are_converted_once(handler):
+    lambda_handler, server, lambda_client = handler
+    runs = server.stats["batch_runs"]
+
+    response = lambda_handler.main(sqs_event({"vin": "V1", "incident": "I1"}, {"vin": "V1", "incident": "I1"},
+                                             {"vin": "V2", "incident": "I2"}), run_benchmark.FakeContext())
+
+    assert response == {"batchItemFailures": []}
+    assert server.stats["batch_runs"] == runs + 1
+    assert [feed["vin"] for feed in invoked(lambda_client, TBM_FACTORY_FEED_LAMBDA)] == ["V1"]
+    assert [feed["vin"] for feed in invoked(lambda_client, VP4R_FACTORY_FEED_LAMBDA)] == ["V2"]
+
+
+def test_permanent_failures_are_not_redelivered(handler):
+    lambda_handler, server, lambda_client = handler
+
+    response = lambda_handler.main(sqs_event({"vin": "V3", "incident": "I3"}, {"vin": "V4", "incident": "I4"},
+                                             {"vin": "V9", "incident": "I9"}, "not json", {"incident": "I5"}),
+                                   run_benchmark.FakeContext())
+
+    assert response == {"batchItemFailures": []}
+    assert {"I3", "I4", "I9"} <= {update["incident"] for update in invoked(lambda_client, DRIVEIT_UPDATE_LAMBDA)}
+
+
+def test_transient_failures_are_redelivered(handler, failing_batch):
+    lambda_handler, server, lambda_client = handler
+
+    response = lambda_handler.main(sqs_event({"vin": "V1", "incident": "I1"}, {"vin": "V1", "incident": "I1"},
+                                             {"vin": "V3", "incident": "I3"}), run_benchmark.FakeContext())
+
+    assert failed_message_ids(response) == ["m0", "m1"]
+
+
+def test_incident_updated_on_every_failure_by_default(handler, failing_batch):
+    lambda_handler, server, lambda_client = handler
+
+    lambda_handler.main(sqs_event({"vin": "V1", "incident": "I1"}), run_benchmark.FakeContext())
+
+    assert [update["incident"] for update in invoked(lambda_client, DRIVEIT_UPDATE_LAMBDA)] == ["I1"]
+
+
+def test_incident_updated_on_last_delivery(handler, failing_batch, monkeypatch):
+    lambda_handler, server, lambda_client = handler
+    monkeypatch.setattr(lambda_handler, "SQS_MAX_RECEIVE_COUNT", 3)
+
+    response = lambda_handler.main(sqs_event({"vin": "V1", "incident": "I1"}, receive_count=2),
+                                   run_benchmark.FakeContext())
+    assert failed_message_ids(response) == ["m0"]
+    assert invoked(lambda_client, DRIVEIT_UPDATE_LAMBDA) == []
+
+    response = lambda_handler.main(sqs_event({"vin": "V1", "incident": "I1"}, receive_count=3),
+                                   run_benchmark.FakeContext())
+    assert failed_message_ids(response) == ["m0"]
+    assert [update["incident"] for update in invoked(lambda_client, DRIVEIT_UPDATE_LAMBDA)] == ["I1"]
+
+
+def test_failed_factory_feed_is_sent_again(handler, monkeypatch):
+    import outcomes
+
+    lambda_handler, server, lambda_client = handler
+    invoke = lambda_client.invoke
+
+    def failing_feed(FunctionName, InvocationType, Payload):
+        if FunctionName == TBM_FACTORY_FEED_LAMBDA:
+            raise RuntimeError("factory feed down")
+        return invoke(FunctionName, InvocationType, Payload)
+
+    monkeypatch.setattr(lambda_client, "invoke", failing_feed)
+    response = lambda_handler.main(sqs_event({"vin": "V1", "incident": "I1"}), run_benchmark.FakeContext())
+    assert failed_message_ids(response) == ["m0"]
+    assert invoked(lambda_client, TBM_FACTORY_FEED_LAMBDA) == []
+
+    monkeypatch.setattr(lambda_client, "invoke", invoke)
+    lambda_client.invocations.clear()
+    runs = server.stats["batch_runs"]
+    response = lambda_handler.main(sqs_event({"vin": "V1", "incident": "I1"}, receive_count=2),
+                                   run_benchmark.FakeContext())
+    assert response == {"batchItemFailures": []}
+    assert server.stats["batch_runs"] == runs
+    assert [feed["vin"] for feed in invoked(lambda_client, TBM_FACTORY_FEED_LAMBDA)] == ["V1"]
+    assert invoked(lambda_client, DRIVEIT_UPDATE_LAMBDA) == []
+    assert [(entry["vin"], entry["category"]) for entry in outcomes.get_store().records] == [
+        ("V1", outcomes.FEED_NOT_SENT), ("V1", outcomes.CONVERTED)]
@@ -0,0 +1,234 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+
+TRACE_ENABLED = os.getenv("trace_enabled", "true").lower() == "true"
+TRACE_NAMESPACE = os.getenv("trace_namespace", "CA_TO_US")
+HISTOGRAM_SIZE = int(os.getenv("trace_histogram_size", 10000))
+EMF_UNIT = "Milliseconds"
+COUNT_UNIT = "Count"
+
+LOG = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Last durations of a stage, in milliseconds"""
+
+    def __init__(self, size=HISTOGRAM_SIZE):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, duration_ms):
+        self.samples.append(duration_ms)
+        self.count += 1
+
+    def percentile(self, percent):
+        """
+        :param percent: float between 0 and 100
+        :return float, nearest-rank percentile of the kept samples, None when empty
+        """
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        rank = max(0, min(len(ordered) - 1, math.ceil(percent / 100 * len(ordered)) - 1))
+        return ordered[rank]
+
+    def summary(self):
+        """
+        :return dict with count, p50, p95, p99 and max
+        """
+        return {
+            "count": self.count,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": max(self.samples) if self.samples else None,
+        }
+
+
+class Invocation:
+    """Stage timings of one invocation"""
+
+    def __init__(self, name, request_id=None):
+        self.name = name
+        self.request_id = request_id
+        self.started_at = time.perf_counter()
+        self.stages = {}
+        self.counts = {}
+        self.counters = {}
+        self.duration_ms = None
+
+    def add(self, stage, duration_ms):
+        self.stages[stage] = self.stages.get(stage, 0.0) + duration_ms
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+
+    def finish(self):
+        self.duration_ms = (time.perf_counter() - self.started_at) * 1000
+        return self
+
+    def to_emf(self):
+        """
+        :return dict, CloudWatch embedded metric format record of the invocation
+        """
+        metrics = dict(self.stages)
+        metrics["invocation"] = self.duration_ms
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": TRACE_NAMESPACE,
+                    "Dimensions": [["Function"]],
+                    "Metrics": [{"Name": stage, "Unit": EMF_UNIT} for stage in metrics]
+                    + [{"Name": counter, "Unit": COUNT_UNIT} for counter in self.counters],
+                }],
+            },
+            "Function": self.name,
+            "RequestId": self.request_id,
+            "StageCounts": self.counts,
+        }
+        record.update({stage: round(duration, 3) for stage, duration in metrics.items()})
+        record.update(self.counters)
+        return record
+
+
+histograms = {}
+hooks = []
+_lock = threading.Lock()
+_invocation = None
+
+
+def record(stage, duration_ms):
+    """
+    Adds a stage duration to the histograms and to the current invocation
+    :param stage: string, name of the stage
+    :param duration_ms: float
+    """
+    with _lock:
+        histograms.setdefault(stage, Histogram()).add(duration_ms)
+        if _invocation is not None:
+            _invocation.add(stage, duration_ms)
+
+
+def increment(counter, value=1):
+    """
+    Adds to a counter of the current invocation, emitted as a Count metric
+    :param counter: string, name of the counter
+    :param value: int
+    """
+    with _lock:
+        if _invocation is not None:
+            _invocation.counters[counter] = _invocation.counters.get(counter, 0) + value
+
+
+@contextmanager
+def span(stage):
+    """
+    Times the enclosed block as a stage
+    :param stage: string, name of the stage
+    """
+    if not TRACE_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, (time.perf_counter() - start) * 1000)
+
+
+def traced(stage):
+    """
+    Decorator timing every call of the function as a stage
+    :param stage: string, name of the stage
+    """
+    def deco_traced(f):
+        @wraps(f)
+        def f_traced(*args, **kwargs):
+            with span(stage):
+                return f(*args, **kwargs)
+
+        return f_traced
+
+    return deco_traced
+
+
+def start_invocation(name, context=None):
+    """
+    Starts collecting the stages of an invocation. Lambda runs one invocation at a time per container,
+    so the stages of all the threads are attributed to it.
+    :param name: string, name of the function
+    :param context: lambda context
+    """
+    global _invocation
+    with _lock:
+        _invocation = Invocation(name, getattr(context, "aws_request_id", None))
+
+
+def finish_invocation():
+    """
+    Ends the current invocation, emits its EMF record on stdout and passes it to the hooks
+    :return Invocation or None
+    """
+    global _invocation
+    with _lock:
+        invocation, _invocation = _invocation, None
+    if invocation is None:
+        return None
+    invocation.finish()
+    record("invocation", invocation.duration_ms)
+    if TRACE_ENABLED:
+        print(json.dumps(invocation.to_emf()), flush=True)
+    for hook in list(hooks):
+        try:
+            hook(invocation)
+        except Exception as e:
+            LOG.warning("Trace hook failed : %s", e)
+    return invocation
+
+
+def current_stages():
+    """
+    :return request_id: string, id of the current invocation, None outside an invocation
+    :return stages: dict of stage -> milliseconds spent so far in the current invocation
+    """
+    with _lock:
+        if _invocation is None:
+            return None, {}
+        return _invocation.request_id, dict(_invocation.stages)
+
+
+def add_hook(hook):
+    """
+    Registers a function called with every finished Invocation, e.g. by a benchmark
+    :param hook: function
+    """
+    hooks.append(hook)
+
+
+def remove_hook(hook):
+    """
+    :param hook: function registered with add_hook
+    """
+    if hook in hooks:
+        hooks.remove(hook)
+
+
+def stage_summary():
+    """
+    :return dict of stage -> count, p50, p95, p99 and max in milliseconds
+    """
+    with _lock:
+        return {stage: histogram.summary() for stage, histogram in histograms.items()}
+
+
+def reset():
+    """Drops the collected histograms"""
+    with _lock:
+        histograms.clear()